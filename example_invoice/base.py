@@ -180,6 +180,17 @@ LOGIN_REDIRECT_URL = reverse_lazy('project.dash')
 
 CONTACT_MODEL = 'contact.Contact'
 
+# http://niwinz.github.io/django-redis/latest/
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        }
+    }
+}
+
 # https://github.com/johnsensible/django-sendfile
 SENDFILE_BACKEND = 'sendfile.backends.development'
 SENDFILE_ROOT = 'media-private'
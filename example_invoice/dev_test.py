@@ -15,3 +15,9 @@ DATABASES = {
 
 # http://docs.celeryproject.org/en/2.5/django/unit-testing.html
 CELERY_ALWAYS_EAGER = True
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
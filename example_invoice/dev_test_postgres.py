@@ -0,0 +1,15 @@
+# -*- encoding: utf-8 -*-
+from example_invoice.dev_test import *
+
+
+# to run the tests which need row locking e.g. 'test_invoice_parallel.py'
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'NAME': 'dev_test_invoice',
+        'USER': 'postgres',
+        'PASSWORD': '',
+        'HOST': '',
+        'PORT': '',
+    }
+}
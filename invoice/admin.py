@@ -2,11 +2,25 @@
 from django.contrib import admin
 
 from .models import (
+    InvoiceBatch,
     InvoiceSettings,
     TimeCode,
 )
 
 
+class InvoiceBatchAdmin(admin.ModelAdmin):
+    list_display = (
+        'created',
+        'iteration_end',
+        'shard_count',
+        'shards_complete',
+        'invoice_count',
+        'error_count',
+    )
+
+admin.site.register(InvoiceBatch, InvoiceBatchAdmin)
+
+
 class InvoiceSettingsAdmin(admin.ModelAdmin):
     pass
 
@@ -0,0 +1,119 @@
+# -*- encoding: utf-8 -*-
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from invoice.models import Invoice, InvoiceLine
+from invoice.service import InvoicePrint
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Time 'create_pdf' for invoices with many lines "
+        "(the lines are copied from an invoice and rolled back)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--invoice',
+            dest='invoice',
+            type=int,
+            help='Copy the lines from this invoice (default the latest)',
+        )
+        parser.add_argument(
+            '--lines',
+            dest='lines',
+            nargs='+',
+            type=int,
+            default=[500, 1000, 2000, 4000],
+            help='Number of invoice lines (e.g. --lines 500 1000 2000)',
+        )
+        parser.add_argument(
+            '--single-table',
+            action='store_true',
+            dest='single_table',
+            default=False,
+            help='Compare with the lines drawn in a single table',
+        )
+
+    def _template(self, invoice_pk):
+        """The invoice (and line) to copy."""
+        qs = InvoiceLine.objects.select_related('invoice')
+        if invoice_pk:
+            qs = qs.filter(invoice__pk=invoice_pk)
+        invoice_line = qs.order_by('-invoice__pk', 'line_number').first()
+        if not invoice_line:
+            raise CommandError('Cannot find an invoice with lines to copy')
+        return invoice_line
+
+    def _time(self, report, template, count):
+        """Create an invoice with ``count`` lines and time ``create_pdf``.
+
+        The invoice is rolled back and the PDF is deleted.
+
+        """
+        with transaction.atomic():
+            invoice = Invoice(
+                contact=template.invoice.contact,
+                invoice_date=template.invoice.invoice_date,
+                number=Invoice.objects.next_number(),
+                user=template.invoice.user,
+            )
+            invoice.save()
+            lines = []
+            for line_number in range(1, count + 1):
+                invoice_line = InvoiceLine(
+                    description=template.description,
+                    invoice=invoice,
+                    line_number=line_number,
+                    price=template.price,
+                    product=template.product,
+                    quantity=template.quantity,
+                    units=template.units,
+                    user=template.user,
+                    vat_code=template.vat_code,
+                )
+                invoice_line.calculate()
+                lines.append(invoice_line)
+            InvoiceLine.objects.bulk_create(lines)
+            invoice.update_totals()
+            start = time.time()
+            try:
+                report.create_pdf(invoice, None)
+                seconds = time.time() - start
+            finally:
+                if invoice.pdf:
+                    invoice.pdf.delete(save=False)
+                transaction.set_rollback(True)
+        return seconds
+
+    def handle(self, *args, **options):
+        template = self._template(options.get('invoice'))
+        tables = [('Chunks', False)]
+        if options.get('single_table'):
+            tables.append(('Single table', True))
+        for name, single_table in tables:
+            report = InvoicePrint()
+            if single_table:
+                report.TABLE_CHUNK_ROWS = sys.maxsize
+            per_line = []
+            for count in options.get('lines') or []:
+                seconds = self._time(report, template, count)
+                per_line.append(seconds * 1000 / count)
+                self.stdout.write(
+                    "{}: {} lines in {:.2f} seconds ({:.2f}ms per "
+                    "line)".format(name, count, seconds, per_line[-1])
+                )
+            if len(per_line) > 1:
+                # about 1 if the time grows in line with the number of lines
+                self.stdout.write(
+                    "{}: ms per line for {} lines / {} lines: {:.2f}".format(
+                        name,
+                        options['lines'][-1],
+                        options['lines'][0],
+                        per_line[-1] / per_line[0],
+                    )
+                )
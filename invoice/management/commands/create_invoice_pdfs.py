@@ -0,0 +1,95 @@
+# -*- encoding: utf-8 -*-
+import time
+
+from datetime import datetime
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from invoice.service import InvoicePrint
+
+
+class Command(BaseCommand):
+
+    help = "Create the PDF for draft invoices (using a pool of processes)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--from-date',
+            dest='from_date',
+            help='Invoice date on or after (e.g. 2017-01-31)',
+        )
+        parser.add_argument(
+            '--to-date',
+            dest='to_date',
+            help='Invoice date on or before (e.g. 2017-01-31)',
+        )
+        parser.add_argument(
+            '--contact',
+            dest='contact',
+            help='Slug of the contact',
+        )
+        parser.add_argument(
+            '--processes',
+            dest='processes',
+            type=int,
+            help='Number of processes (default is one per CPU)',
+        )
+
+    def _date(self, value):
+        if value:
+            try:
+                return datetime.strptime(value, '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError("Invalid date '{}'".format(value))
+        return None
+
+    def _contact(self, slug):
+        if slug:
+            model = apps.get_model(settings.CONTACT_MODEL)
+            try:
+                return model.objects.get(slug=slug)
+            except model.DoesNotExist:
+                raise CommandError("Contact '{}' does not exist".format(slug))
+        return None
+
+    def handle(self, *args, **options):
+        invoice_print = InvoicePrint()
+        qs = invoice_print.drafts(
+            from_date=self._date(options.get('from_date')),
+            to_date=self._date(options.get('to_date')),
+            contact=self._contact(options.get('contact')),
+        )
+        numbers = dict(qs.values_list('pk', 'number'))
+        start = time.time()
+        results = invoice_print.create_pdfs(
+            sorted(numbers, key=numbers.get),
+            processes=options.get('processes'),
+        )
+        seconds = time.time() - start
+        created = errors = 0
+        for result in results:
+            number = numbers[result['pk']]
+            if result['error']:
+                errors = errors + 1
+                self.stdout.write("Invoice {}: failed ({})".format(
+                    number, result['error']
+                ))
+            elif result['file_name']:
+                created = created + 1
+                self.stdout.write("Invoice {}: created {} ({:.2f}s)".format(
+                    number, result['file_name'], result['seconds']
+                ))
+            else:
+                self.stdout.write(
+                    "Invoice {}: already has a PDF".format(number)
+                )
+        self.stdout.write(
+            "Created {} PDFs ({} failed) in {:.1f} seconds ({:.1f} invoices "
+            "per second)".format(
+                created,
+                errors,
+                seconds,
+                len(results) / seconds if seconds else 0,
+            )
+        )
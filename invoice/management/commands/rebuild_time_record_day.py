@@ -0,0 +1,40 @@
+# -*- encoding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from invoice.models import TimeRecordDay
+
+
+class Command(BaseCommand):
+
+    help = "Check (and rebuild) the daily totals for the time records"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            dest='verify',
+            default=False,
+            help='Report incorrect daily totals (do not rebuild)',
+        )
+
+    def handle(self, *args, **options):
+        verify = options.get('verify', False)
+        differences = TimeRecordDay.objects.verify()
+        for key, stored, expected in differences:
+            user_pk, ticket_pk, day = key
+            self.stdout.write(
+                "User {}, ticket {} on {}: stored {}, time records {}".format(
+                    user_pk, ticket_pk, day, stored, expected
+                )
+            )
+        if verify:
+            self.stdout.write(
+                "{} daily totals are incorrect".format(len(differences))
+            )
+        else:
+            count = TimeRecordDay.objects.rebuild()
+            self.stdout.write(
+                "Rebuilt {} daily totals ({} were incorrect)".format(
+                    count, len(differences)
+                )
+            )
@@ -0,0 +1,29 @@
+# -*- encoding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from invoice.models import Invoice, InvoiceSequence
+
+
+class Command(BaseCommand):
+
+    help = "Check the invoice numbers are sequential"
+
+    def handle(self, *args, **options):
+        gaps = Invoice.objects.number_gaps()
+        for first, last in gaps:
+            if first == last:
+                self.stdout.write("Missing invoice number {}".format(first))
+            else:
+                self.stdout.write(
+                    "Missing invoice numbers {} to {}".format(first, last)
+                )
+        sequence = InvoiceSequence.objects.first()
+        last_number = Invoice.objects.last_number()
+        if sequence and sequence.last_number != last_number:
+            self.stdout.write(
+                "The last invoice number is {}, but the sequence is "
+                "at {}".format(last_number, sequence.last_number)
+            )
+        self.stdout.write("Found {} gaps in the invoice numbers".format(
+            len(gaps)
+        ))
@@ -0,0 +1,74 @@
+# -*- encoding: utf-8 -*-
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from base.model_utils import private_file_store
+from invoice.models import Invoice
+
+
+class Command(BaseCommand):
+
+    help = "Delete invoice PDFs which are not used by any invoice"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help='List the unused PDFs (do not delete them)',
+        )
+        parser.add_argument(
+            '--hours',
+            dest='hours',
+            type=int,
+            default=24,
+            help=(
+                'Only delete PDFs which are older than this (so we do not '
+                'delete a PDF which is being saved), default 24'
+            ),
+        )
+
+    def _file_names(self, path):
+        """The names of the files in ``path`` (and the folders below it)."""
+        folders, files = private_file_store.listdir(path)
+        for name in files:
+            yield '{}/{}'.format(path, name)
+        for folder in folders:
+            yield from self._file_names('{}/{}'.format(path, folder))
+
+    def handle(self, *args, **options):
+        dry_run = options.get('dry_run', False)
+        hours = options.get('hours', 24)
+        before = timezone.now() - timedelta(hours=hours)
+        used = set()
+        for pdf, previous_pdf in Invoice.objects.values_list(
+                'pdf', 'previous_pdf'):
+            used.update([pdf, previous_pdf])
+        count = 0
+        size = 0
+        file_names = []
+        # the folder for the invoice PDFs (see 'upload_to' on 'Invoice.pdf')
+        path = 'invoice'
+        if private_file_store.exists(path):
+            file_names = self._file_names(path)
+        for name in file_names:
+            if name in used:
+                continue
+            if private_file_store.get_modified_time(name) > before:
+                continue
+            count = count + 1
+            size = size + private_file_store.size(name)
+            self.stdout.write(name)
+            if not dry_run:
+                private_file_store.delete(name)
+        if dry_run:
+            self.stdout.write(
+                "Found {} unused PDFs ({} bytes)".format(count, size)
+            )
+        else:
+            self.stdout.write(
+                "Deleted {} unused PDFs ({} bytes)".format(count, size)
+            )
@@ -0,0 +1,48 @@
+# -*- encoding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from invoice.models import Invoice
+
+
+class Command(BaseCommand):
+
+    help = "Check (and update) the stored totals on each invoice"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            dest='verify',
+            default=False,
+            help='Report invoices with incorrect totals (do not update)',
+        )
+
+    def handle(self, *args, **options):
+        verify = options.get('verify', False)
+        count = 0
+        errors = 0
+        for invoice in Invoice.objects.with_totals().order_by('pk'):
+            totals = invoice.line_totals()
+            stored = {name: getattr(invoice, name) for name in totals}
+            if stored != totals:
+                errors = errors + 1
+                self.stdout.write(
+                    "Invoice {}: stored {}, lines {}".format(
+                        invoice.invoice_number, stored, totals
+                    )
+                )
+                if not verify:
+                    invoice.update_totals()
+            count = count + 1
+        if verify:
+            self.stdout.write(
+                "Checked {} invoices: {} have incorrect totals".format(
+                    count, errors
+                )
+            )
+        else:
+            self.stdout.write(
+                "Checked {} invoices: updated the totals on {}".format(
+                    count, errors
+                )
+            )
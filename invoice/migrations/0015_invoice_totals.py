@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+def _update_totals(apps, schema_editor):
+    model = apps.get_model('invoice', 'Invoice')
+    for invoice in model.objects.all():
+        totals = invoice.invoiceline_set.aggregate(
+            line_count=models.Count('pk'),
+            net=models.Sum('net'),
+            vat=models.Sum('vat'),
+        )
+        net = totals['net'] or Decimal()
+        vat = totals['vat'] or Decimal()
+        model.objects.filter(pk=invoice.pk).update(
+            gross=net + vat,
+            line_count=totals['line_count'],
+            net=net,
+            vat=vat,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoice', '0014_invoiceuser'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='gross',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='line_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='net',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='vat',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=10),
+        ),
+        migrations.RunPython(_update_totals, migrations.RunPython.noop),
+    ]
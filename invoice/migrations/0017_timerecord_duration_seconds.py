@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import datetime
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def _duration_seconds(apps, schema_editor):
+    model = apps.get_model('invoice', 'TimeRecord')
+    qs = model.objects.filter(
+        date_started__isnull=False,
+        start_time__isnull=False,
+        end_time__isnull=False,
+    ).values_list(
+        'pk',
+        'date_started',
+        'start_time',
+        'end_time',
+    )
+    for pk, date_started, start_time, end_time in qs.iterator():
+        td = (
+            datetime.combine(date_started, end_time) -
+            datetime.combine(date_started, start_time)
+        )
+        model.objects.filter(pk=pk).update(
+            duration_seconds=td.days * 86400 + td.seconds
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('invoice', '0016_invoicesequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='timerecord',
+            name='duration_seconds',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='timerecord',
+            index_together=set([('user', 'date_started')]),
+        ),
+        migrations.RunPython(_duration_seconds, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def _rebuild(apps, schema_editor):
+    """Total the complete time records for each user, ticket and day.
+
+    The minutes for each time record are truncated (before they are added
+    up).
+
+    """
+    model = apps.get_model('invoice', 'TimeRecord')
+    model_day = apps.get_model('invoice', 'TimeRecordDay')
+    qs = model.objects.filter(
+        duration_seconds__isnull=False,
+    ).values_list(
+        'user',
+        'ticket',
+        'date_started',
+        'billable',
+        'duration_seconds',
+    )
+    totals = {}
+    for row in qs.iterator():
+        user, ticket, day, billable, seconds = row
+        key = (user, ticket, day)
+        if not key in totals:
+            totals[key] = model_day(date=day, ticket_id=ticket, user_id=user)
+        obj = totals[key]
+        if billable:
+            obj.billable_minutes = obj.billable_minutes + seconds // 60
+        else:
+            obj.non_billable_minutes = obj.non_billable_minutes + seconds // 60
+    model_day.objects.bulk_create(totals.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0006_auto_20160125_1153'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('invoice', '0017_timerecord_duration_seconds'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimeRecordDay',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('billable_minutes', models.IntegerField(default=0)),
+                ('non_billable_minutes', models.IntegerField(default=0)),
+                ('ticket', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='crm.Ticket')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['date'],
+                'verbose_name': 'Time record day',
+                'verbose_name_plural': 'Time record days',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='timerecordday',
+            unique_together=set([('user', 'ticket', 'date')]),
+        ),
+        migrations.RunPython(_rebuild, migrations.RunPython.noop),
+    ]
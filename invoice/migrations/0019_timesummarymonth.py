@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('invoice', '0018_timerecordday'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimeSummaryMonth',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('charge_minutes', models.IntegerField()),
+                ('fixed_minutes', models.IntegerField()),
+                ('non_minutes', models.IntegerField()),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['month'],
+                'verbose_name': 'Time summary month',
+                'verbose_name_plural': 'Time summary months',
+            },
+        ),
+        migrations.AlterField(
+            model_name='timerecord',
+            name='date_started',
+            field=models.DateField(db_index=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='timesummarymonth',
+            unique_together=set([('user', 'month')]),
+        ),
+        # 'unique_together' does not stop two markers (no user) for a month
+        migrations.RunSQL(
+            "CREATE UNIQUE INDEX invoice_timesummarymonth_marker "
+            "ON invoice_timesummarymonth (month) WHERE user_id IS NULL",
+            "DROP INDEX invoice_timesummarymonth_marker",
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('invoice', '0019_timesummarymonth'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvoicePrintJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('status', models.CharField(choices=[('complete', 'Complete'), ('failed', 'Failed'), ('pending', 'Pending')], default='pending', max_length=10)),
+                ('message', models.TextField(blank=True)),
+                ('invoice', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='invoice.Invoice')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created'],
+                'verbose_name': 'Invoice print job',
+                'verbose_name_plural': 'Invoice print jobs',
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.core.files.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoice', '0020_invoiceprintjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='pdf_fingerprint',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='previous_pdf',
+            field=models.FileField(blank=True, storage=django.core.files.storage.FileSystemStorage(location='media-private'), upload_to='invoice/%Y/%m/%d'),
+        ),
+    ]
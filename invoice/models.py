@@ -1,15 +1,21 @@
 # -*- encoding: utf-8 -*-
 import collections
+import functools
+import operator
 
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from dateutil.rrule import WEEKLY, rrule, SU
 from decimal import Decimal
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
-from django.db import models, transaction
-from django.db.models import Max
+from django.db import connection, IntegrityError, models, transaction
+from django.db.models import Max, Min
+from django.db.models.functions import Coalesce, TruncMonth
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.timesince import timeuntil
 from reversion import revisions as reversion
@@ -25,6 +31,20 @@ from finance.models import VatCode
 from stock.models import Product
 
 
+# one week (the time summary for a day is removed when a time record changes)
+TIME_SUMMARY_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+
+# the time for all users for the dashboard (removed when a time record changes)
+DASH_CACHE_KEY = 'invoice_dash_time'
+DASH_CACHE_TIMEOUT = 60 * 5
+
+
+def time_summary_cache_key(user_pk, day):
+    """Cache key for the time summary for a user for a day."""
+    return 'invoice_time_summary_{}_{}'.format(user_pk, day.strftime('%Y%m%d'))
+
+
 class InvoiceContact(TimeStampedModel):
 
     contact = models.OneToOneField(settings.CONTACT_MODEL)
@@ -60,15 +80,99 @@ class InvoiceError(Exception):
 
 class InvoiceManager(models.Manager):
 
-    def next_number(self):
-        qs = self.model.objects.exclude(
+    def with_totals(self):
+        """Annotate the totals of the invoice lines (in a single query).
+
+        ``Invoice.line_totals`` will use these annotations (rather than
+        running an aggregate query for each invoice).
+
+        """
+        lines = InvoiceLine.objects.filter(
+            invoice=models.OuterRef('pk'),
+        ).order_by().values('invoice')
+        amount = models.DecimalField(max_digits=10, decimal_places=2)
+        count = models.IntegerField()
+        return self.model.objects.annotate(
+            total_line_count=Coalesce(
+                models.Subquery(
+                    lines.annotate(total=models.Count('pk')).values('total'),
+                    output_field=count,
+                ),
+                models.Value(0),
+                output_field=count,
+            ),
+            total_net=Coalesce(
+                models.Subquery(
+                    lines.annotate(total=models.Sum('net')).values('total'),
+                    output_field=amount,
+                ),
+                models.Value(Decimal()),
+                output_field=amount,
+            ),
+            total_vat=Coalesce(
+                models.Subquery(
+                    lines.annotate(total=models.Sum('vat')).values('total'),
+                    output_field=amount,
+                ),
+                models.Value(Decimal()),
+                output_field=amount,
+            ),
+        ).annotate(
+            total_gross=models.ExpressionWrapper(
+                models.F('total_net') + models.F('total_vat'),
+                output_field=amount,
+            ),
+            total_is_credit=models.Case(
+                models.When(total_net__lt=Decimal(), then=models.Value(True)),
+                default=models.Value(False),
+                output_field=models.BooleanField(),
+            ),
+        )
+
+    def current(self):
+        """Invoices which have not been deleted."""
+        return self.model.objects.exclude(
             deleted=True,
         ).exclude(
             deleted_version__gt=0,
         )
-        result = qs.aggregate(max_id=Max('number'))
-        current_number = result.get('max_id') or 0
-        return current_number + 1
+
+    def last_number(self):
+        """The highest invoice number (scans the invoice table).
+
+        An invoice being created has a temporary (negative) number until the
+        number is allocated (see ``InvoiceCreate.create``), so is ignored.
+
+        """
+        result = self.current().filter(
+            number__gt=0,
+        ).aggregate(max_id=Max('number'))
+        return result.get('max_id') or 0
+
+    def next_number(self):
+        """The next invoice number (from the invoice sequence).
+
+        The sequence is locked until the end of the transaction, so save the
+        invoice in the same transaction.
+
+        """
+        return InvoiceSequence.objects.next_number()
+
+    def number_gaps(self):
+        """Check the invoice numbers are sequential (for the VAT rules).
+
+        Returns a list of ``(first, last)`` tuples for each range of missing
+        invoice numbers.
+
+        """
+        result = []
+        expect = 1
+        qs = self.current().order_by('number').values_list('number', flat=True)
+        for number in qs.iterator():
+            if number > expect:
+                result.append((expect, number - 1))
+            expect = number + 1
+        return result
 
 
 class Invoice(TimedCreateModifyDeleteVersionModel):
@@ -116,8 +220,28 @@ class Invoice(TimedCreateModifyDeleteVersionModel):
     pdf = models.FileField(
         upload_to='invoice/%Y/%m/%d', storage=private_file_store, blank=True
     )
+    # fingerprint of the content of the PDF (see 'InvoicePrint._fingerprint')
+    pdf_fingerprint = models.CharField(max_length=64, blank=True)
+    # the PDF from before the invoice was set back to draft (re-used if the
+    # invoice is printed again without any changes)
+    previous_pdf = models.FileField(
+        upload_to='invoice/%Y/%m/%d', storage=private_file_store, blank=True
+    )
+    # totals are maintained by 'update_totals' when the lines are changed
+    net = models.DecimalField(
+        max_digits=10, decimal_places=2, default=Decimal()
+    )
+    vat = models.DecimalField(
+        max_digits=10, decimal_places=2, default=Decimal()
+    )
+    gross = models.DecimalField(
+        max_digits=10, decimal_places=2, default=Decimal()
+    )
+    line_count = models.IntegerField(default=0)
     objects = InvoiceManager()
 
+    TOTAL_FIELD_NAMES = ('net', 'vat', 'gross', 'line_count')
+
     class Meta:
         ordering = ['pk',]
         unique_together = ('number', 'deleted_version')
@@ -130,6 +254,34 @@ class Invoice(TimedCreateModifyDeleteVersionModel):
     def get_absolute_url(self):
         return reverse('invoice.detail', args=[self.pk])
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        obj = super().from_db(db, field_names, values)
+        # so 'save' knows if the invoice number has changed
+        obj._saved_number = dict(zip(field_names, values)).get('number')
+        return obj
+
+    def save(self, *args, **kwargs):
+        """Save the invoice without overwriting the totals.
+
+        The totals are maintained by ``update_totals`` (from the invoice
+        lines), so we don't want a stale instance to overwrite them.
+
+        If the invoice is saved with a number, the invoice sequence is moved
+        forward (so the number is not allocated again).
+
+        """
+        if not self._state.adding and 'update_fields' not in kwargs:
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in self.TOTAL_FIELD_NAMES
+            ]
+        saved_number = getattr(self, '_saved_number', None)
+        super().save(*args, **kwargs)
+        if self.number > 0 and self.number != saved_number:
+            InvoiceSequence.objects.follow(self.number)
+        self._saved_number = self.number
+
     @property
     def can_set_to_draft(self):
         """Can we set this invoice back to a draft state?"""
@@ -140,17 +292,58 @@ class Invoice(TimedCreateModifyDeleteVersionModel):
         return result
 
     def get_next_line_number(self):
-        try:
-            self.line_number = self.line_number
-        except AttributeError:
-            self.line_number = 1
-        while(True):
-            try:
-                self.invoiceline_set.get(line_number=self.line_number)
-            except InvoiceLine.DoesNotExist:
-                break
-            self.line_number = self.line_number + 1
-        return self.line_number
+        """The next free line number for the invoice.
+
+        The invoice row is locked, so call this inside the transaction which
+        saves the line (if you want it to be safe from concurrent updates).
+
+        If there are no gaps in the line numbers (the usual case), a single
+        query will find the number, otherwise we fill the first gap.
+
+        """
+        with transaction.atomic():
+            self._lock()
+            result = self.invoiceline_set.aggregate(
+                count=models.Count('pk'),
+                max_line_number=Max('line_number'),
+                min_line_number=Min('line_number'),
+            )
+            count = result['count']
+            if not count or (
+                    result['min_line_number'] == 1 and
+                    result['max_line_number'] == count):
+                return count + 1
+            line_numbers = set(
+                self.invoiceline_set.values_list('line_number', flat=True)
+            )
+        line_number = 1
+        while line_number in line_numbers:
+            line_number = line_number + 1
+        return line_number
+
+    def _lock(self):
+        """Lock the invoice row (until the end of the transaction)."""
+        qs = Invoice.objects.select_for_update().filter(pk=self.pk)
+        list(qs.values_list('pk', flat=True))
+
+    def reserve_line_numbers(self, count):
+        """Reserve a block of line numbers (for adding lines in bulk).
+
+        Returns a ``range`` of line numbers after the last line on the
+        invoice.  The invoice row is locked until the end of the transaction,
+        so this must be called inside the transaction which saves the lines.
+
+        """
+        if not transaction.get_connection().in_atomic_block:
+            raise InvoiceError(
+                "Line numbers can only be reserved inside a transaction."
+            )
+        self._lock()
+        result = self.invoiceline_set.aggregate(
+            max_line_number=Max('line_number'),
+        )
+        start = (result['max_line_number'] or 0) + 1
+        return range(start, start + count)
 
     def time_analysis(self):
         """Time analysis by user and ticket for an invoice.
@@ -173,49 +366,46 @@ class Invoice(TimedCreateModifyDeleteVersionModel):
         }
 
         """
+        qs = self.invoiceline_set.order_by().values(
+            'timerecord__user__username',
+            'timerecord__ticket',
+        ).annotate(
+            duration_seconds=models.Sum('timerecord__duration_seconds'),
+            end_created=Max('created'),
+            end_date=Max('timerecord__date_started'),
+            start_created=Min('created'),
+            start_date=Min('timerecord__date_started'),
+            total_net=models.Sum('net'),
+            total_quantity=models.Sum('quantity'),
+        )
+        rows = sorted(qs, key=lambda row: (
+            row['timerecord__user__username'] or '',
+            row['timerecord__ticket'] or 0,
+        ))
         result = {}
-        qs = self.invoiceline_set.all()
-        for line in qs:
-            user_name = ''
-            quantity = line.quantity
-            if line.has_time_record:
-                user_name = line.timerecord.user.username
+        for row in rows:
+            user_name = row['timerecord__user__username'] or ''
+            if row['timerecord__ticket']:
+                pk = row['timerecord__ticket']
+                start_date = row['start_date']
+                end_date = row['end_date']
                 # line.quantity does not have sufficient precision
-                tx = (datetime.combine(
-                        line.timerecord.date_started,
-                        line.timerecord.end_time
-                    )
-                    - datetime.combine(
-                        line.timerecord.date_started,
-                        line.timerecord.start_time
-                    )
+                quantity = (
+                    Decimal(row['duration_seconds'] or 0) / Decimal('3600')
                 )
-                quantity = Decimal((tx.seconds / 3600))
-            if not user_name in result:
-                result[user_name] = {}
-            tickets = result[user_name]
-            if line.has_time_record:
-                pk = line.timerecord.ticket.pk
-                start_date = line.timerecord.date_started
-                end_date = line.timerecord.date_started
             else:
                 pk = 0
-                start_date = line.created
-                end_date = line.created
-            if not pk in tickets:
-                tickets[pk] = dict(
-                    start_date=start_date,
-                    end_date=end_date,
-                    quantity=Decimal(),
-                    net=Decimal(),
-                )
-            totals = tickets[pk]
-            if totals['start_date'] > start_date:
-                totals['start_date'] = start_date
-            if totals['end_date'] < end_date:
-                totals['end_date'] = end_date
-            totals['net'] = totals['net'] + line.net
-            totals['quantity'] = totals['quantity'] + quantity
+                start_date = row['start_created']
+                end_date = row['end_created']
+                quantity = row['total_quantity']
+            if not user_name in result:
+                result[user_name] = {}
+            result[user_name][pk] = dict(
+                start_date=start_date,
+                end_date=end_date,
+                quantity=quantity,
+                net=row['total_net'],
+            )
         return result
 
     @property
@@ -225,19 +415,9 @@ class Invoice(TimedCreateModifyDeleteVersionModel):
         else:
             return 'Invoice'
 
-    @property
-    def gross(self):
-        totals = self.invoiceline_set.aggregate(
-            models.Sum('net'), models.Sum('vat')
-        )
-        return (
-            (totals['net__sum'] or Decimal()) +
-            (totals['vat__sum'] or Decimal())
-        )
-
     @property
     def has_lines(self):
-        return bool(self.invoiceline_set.count())
+        return bool(self.line_count)
 
     @property
     def invoice_number(self):
@@ -251,31 +431,68 @@ class Invoice(TimedCreateModifyDeleteVersionModel):
     def is_draft(self):
         return not bool(self.pdf)
 
-    @property
-    def net(self):
-        totals = self.invoiceline_set.aggregate(models.Sum('net'))
-        return totals['net__sum'] or Decimal()
+    def line_totals(self):
+        """Calculate the totals for the invoice from the invoice lines.
+
+        If the invoice was selected using ``Invoice.objects.with_totals``,
+        then the annotated totals are used (and we don't need a query).
+
+        """
+        if hasattr(self, 'total_line_count'):
+            return dict(
+                gross=self.total_gross,
+                line_count=self.total_line_count,
+                net=self.total_net,
+                vat=self.total_vat,
+            )
+        return self._calculate_line_totals()
+
+    def _calculate_line_totals(self):
+        totals = self.invoiceline_set.aggregate(
+            line_count=models.Count('pk'),
+            net=models.Sum('net'),
+            vat=models.Sum('vat'),
+        )
+        net = totals['net'] or Decimal()
+        vat = totals['vat'] or Decimal()
+        return dict(
+            gross=net + vat,
+            line_count=totals['line_count'],
+            net=net,
+            vat=vat,
+        )
 
     def remove_time_lines(self):
+        """Remove the lines which are linked to time records.
+
+        The time records are unlinked with one ``UPDATE`` and the lines are
+        deleted with one ``DELETE`` (lines without a time record are kept).
+
+        """
         if not self.is_draft:
             raise InvoiceError(
                 "Time records can only be removed from a draft invoice."
             )
-        pks = [i.pk for i in self.invoiceline_set.all()]
         with transaction.atomic():
-            for pk in pks:
-                line = InvoiceLine.objects.get(pk=pk)
-                try:
-                    time_record = line.timerecord
-                    time_record.invoice_line = None
-                    time_record.save()
-                    line.delete()
-                except TimeRecord.DoesNotExist:
-                    pass
+            self._lock()
+            pks = list(TimeRecord.objects.filter(
+                invoice_line__invoice=self,
+            ).values_list(
+                'invoice_line',
+                flat=True,
+            ))
+            TimeRecord.objects.filter(
+                invoice_line__in=pks,
+            ).update(
+                invoice_line=None,
+            )
+            InvoiceLine.objects.filter(pk__in=pks).delete()
+            self.update_totals()
 
     def set_to_draft(self):
         """Set the invoice back to a draft state."""
         if self.can_set_to_draft:
+            self.previous_pdf = self.pdf.name
             self.pdf = None
             self.save()
         else:
@@ -284,14 +501,230 @@ class Invoice(TimedCreateModifyDeleteVersionModel):
                 "on the day it was created."
             )
 
-    @property
-    def vat(self):
-        totals = self.invoiceline_set.aggregate(models.Sum('vat'))
-        return totals['vat__sum'] or Decimal()
+    def update_totals(self):
+        """Update the stored totals from the invoice lines.
+
+        The invoice row is locked, so lines saved at the same time (in
+        different transactions) are totalled one after the other.
+
+        """
+        with transaction.atomic():
+            self._lock()
+            totals = self._calculate_line_totals()
+            Invoice.objects.filter(pk=self.pk).update(**totals)
+        for name, value in totals.items():
+            setattr(self, name, value)
 
 reversion.register(Invoice)
 
 
+class InvoicePrintJobManager(models.Manager):
+
+    def create_print_job(self, invoice, user):
+        obj = self.model(invoice=invoice, user=user)
+        obj.save()
+        return obj
+
+
+class InvoicePrintJob(TimeStampedModel):
+    """Create the PDF for an invoice (in the background).
+
+    The view creates the job and the ``invoice_print`` task creates the PDF.
+
+    """
+
+    COMPLETE = 'complete'
+    FAILED = 'failed'
+    PENDING = 'pending'
+    # a job which is still pending after this is probably stuck (e.g. the
+    # background worker is not running)
+    STALE_MINUTES = 5
+
+    STATUS_CHOICES = (
+        (COMPLETE, 'Complete'),
+        (FAILED, 'Failed'),
+        (PENDING, 'Pending'),
+    )
+
+    invoice = models.ForeignKey(Invoice)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL)
+    status = models.CharField(
+        max_length=10,
+        choices=STATUS_CHOICES,
+        default=PENDING,
+    )
+    message = models.TextField(blank=True)
+    objects = InvoicePrintJobManager()
+
+    class Meta:
+        ordering = ['-created']
+        verbose_name = 'Invoice print job'
+        verbose_name_plural = 'Invoice print jobs'
+
+    def __str__(self):
+        return '{} {}'.format(self.invoice.invoice_number, self.status)
+
+    @property
+    def is_complete(self):
+        return self.status == self.COMPLETE
+
+    @property
+    def is_pending(self):
+        return self.status == self.PENDING
+
+    @property
+    def is_stale(self):
+        """Has the job been pending for longer than ``STALE_MINUTES``?"""
+        stale = timezone.now() - timedelta(minutes=self.STALE_MINUTES)
+        return self.is_pending and self.created < stale
+
+
+class InvoiceBatchManager(models.Manager):
+
+    def create_batch(self, user, iteration_end, shard_count):
+        obj = self.model(
+            iteration_end=iteration_end,
+            shard_count=shard_count,
+            user=user,
+        )
+        obj.save()
+        return obj
+
+
+class InvoiceBatch(TimeStampedModel):
+    """A summary of a run of the ``invoice_batch`` task.
+
+    The contacts are invoiced in shards (separate tasks) and each shard adds
+    its results when it is complete (see ``shard_complete``), so the row is
+    the summary for the whole run.
+
+    """
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL)
+    iteration_end = models.DateField()
+    shard_count = models.IntegerField()
+    shards_complete = models.IntegerField(default=0)
+    invoice_count = models.IntegerField(default=0)
+    error_count = models.IntegerField(default=0)
+    errors = models.TextField(blank=True)
+    objects = InvoiceBatchManager()
+
+    class Meta:
+        ordering = ['-created']
+        verbose_name = 'Invoice batch'
+        verbose_name_plural = 'Invoice batches'
+
+    def __str__(self):
+        return '{} ({} of {} shards, {} invoices, {} errors)'.format(
+            self.iteration_end.strftime('%d/%m/%Y'),
+            self.shards_complete,
+            self.shard_count,
+            self.invoice_count,
+            self.error_count,
+        )
+
+    @property
+    def is_complete(self):
+        return self.shards_complete >= self.shard_count
+
+    def shard_complete(self, result):
+        """Add the result of a shard (see ``create_for_contacts``).
+
+        The row is locked, so shards which finish at the same time are added
+        one after the other.
+
+        """
+        with transaction.atomic():
+            obj = InvoiceBatch.objects.select_for_update().get(pk=self.pk)
+            errors = [obj.errors] if obj.errors else []
+            for contact_pk, message in result['errors']:
+                errors.append('contact {}: {}'.format(contact_pk, message))
+            obj.errors = '\n'.join(errors)
+            obj.error_count = obj.error_count + len(result['errors'])
+            obj.invoice_count = obj.invoice_count + len(result['invoices'])
+            obj.shards_complete = obj.shards_complete + 1
+            obj.save()
+        self.refresh_from_db()
+
+
+class InvoiceSequenceManager(models.Manager):
+
+    def _sequence(self):
+        """Lock the sequence (create it from the last invoice number)."""
+        qs = self.model.objects.select_for_update()
+        try:
+            return qs.get(pk=self.model.SEQUENCE_PK)
+        except self.model.DoesNotExist:
+            pass
+        try:
+            with transaction.atomic():
+                return self.model.objects.create(
+                    pk=self.model.SEQUENCE_PK,
+                    last_number=Invoice.objects.last_number(),
+                )
+        except IntegrityError:
+            # created by another transaction
+            return qs.get(pk=self.model.SEQUENCE_PK)
+
+    def follow(self, number):
+        """Move the sequence forward to an invoice saved with a number.
+
+        For an invoice saved with an explicit number (admin, factories or an
+        import), so the number is not allocated again.  If the sequence has
+        not been created, it will start from the highest invoice number.
+
+        """
+        self.model.objects.filter(
+            pk=self.model.SEQUENCE_PK,
+            last_number__lt=number,
+        ).update(last_number=number)
+
+    def next_number(self):
+        """The next invoice number (see ``reserve``)."""
+        return self.reserve()[0]
+
+    def reserve(self, count=None):
+        """Reserve a block of invoice numbers (returns a ``range``).
+
+        The sequence is locked until the end of the transaction, so the
+        invoices should be saved in the same transaction.  If the transaction
+        is rolled back, the numbers are released (so there are no gaps).
+
+        The numbers are never handed out again (even if the invoice is
+        deleted), so a VAT invoice number is only used once.
+
+        """
+        if count is None:
+            count = 1
+        with transaction.atomic():
+            sequence = self._sequence()
+            start = sequence.last_number + 1
+            sequence.last_number = sequence.last_number + count
+            sequence.save()
+        return range(start, start + count)
+
+
+class InvoiceSequence(models.Model):
+    """The last invoice number used.
+
+    Invoice numbers are allocated by locking this row, rather than finding
+    the highest invoice number in the invoice table (see
+    ``InvoiceSequenceManager``).
+
+    """
+
+    SEQUENCE_PK = 1
+
+    last_number = models.IntegerField(default=0)
+    objects = InvoiceSequenceManager()
+
+    class Meta:
+        verbose_name = 'Invoice sequence'
+
+    def __str__(self):
+        return '{}'.format(self.last_number)
+
+
 class InvoiceSettingsManager(models.Manager):
 
     def settings(self):
@@ -382,12 +815,24 @@ class InvoiceLine(TimeStampedModel):
     def get_absolute_url(self):
         return reverse('invoice.detail', args=[self.invoice.pk])
 
-    def save(self, *args, **kwargs):
+    def calculate(self):
+        """Calculate the net and VAT (``bulk_create`` doesn't call ``save``)."""
         self.vat_rate = self.vat_code.rate
         self.net = self._quantize(self.price * self.quantity)
         self.vat = self._quantize(self.price * self.quantity * self.vat_rate)
-        # Call the "real" save() method.
-        super().save(*args, **kwargs)
+
+    def save(self, *args, **kwargs):
+        self.calculate()
+        with transaction.atomic():
+            # Call the "real" save() method.
+            super().save(*args, **kwargs)
+            self.invoice.update_totals()
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            self.invoice.update_totals()
+        return result
 
     def _quantize(self, value):
         return value.quantize(Decimal('.01'))
@@ -498,113 +943,123 @@ class TimeRecordManager(models.Manager):
         obj.save()
         return obj
 
-    def report_charge_non_charge(self, from_date, to_date, user=None):
-        """Report of chargeable and non-chargeable time."""
-        qs = TimeRecord.objects.filter(
+    def _report(self, from_date, to_date, user=None):
+        """Complete time records for a report.
+
+        ``duration_seconds`` is only set when a time record is complete.
+
+        """
+        qs = self.model.objects.filter(
             date_started__gte=from_date,
             date_started__lte=to_date,
+            duration_seconds__isnull=False,
         )
         if user:
             qs = qs.filter(user=user)
+        return qs
+
+    def _report_minutes(self, qs, *group_by, **annotations):
+        """Total the minutes for each group (in a single query).
+
+        ``order_by()`` removes the default ordering from the ``GROUP BY``.
+
+        """
+        return qs.order_by().values(*group_by).annotate(
+            seconds=models.Sum('duration_seconds'),
+            **annotations
+        )
+
+    def _minutes(self, row):
+        return row['seconds'] / 60
+
+    def report_charge_non_charge(self, from_date, to_date, user=None):
+        """Report of chargeable and non-chargeable time."""
+        qs = self._report(from_date, to_date, user).annotate(
+            category=models.Case(
+                models.When(
+                    billable=True,
+                    then=models.Value(TimeRecord.CHARGE),
+                ),
+                default=models.Value(TimeRecord.NON_CHARGE),
+                output_field=models.CharField(),
+            )
+        )
         result = {}
-        for row in qs:
-            if row.is_complete:
-                if row.billable:
-                    if not TimeRecord.CHARGE in result:
-                        result[TimeRecord.CHARGE] = 0
-                    result[TimeRecord.CHARGE] = result[TimeRecord.CHARGE] + row.minutes
-                else:
-                    if not TimeRecord.NON_CHARGE in result:
-                        result[TimeRecord.NON_CHARGE] = 0
-                    result[TimeRecord.NON_CHARGE] = result[TimeRecord.NON_CHARGE] + row.minutes
+        for row in self._report_minutes(qs, 'category'):
+            result[row['category']] = self._minutes(row)
         return result
 
     def report_time_by_contact(self, from_date, to_date, user=None):
-        qs = TimeRecord.objects.filter(
-            date_started__gte=from_date,
-            date_started__lte=to_date,
-        )
-        if user:
-            qs = qs.filter(user=user)
+        qs = self._report(from_date, to_date, user)
         result = {}
-        for row in qs:
-            if row.is_complete:
-                slug = row.ticket.contact.slug
-                if not slug in result:
-                    result[slug] = 0
-                result[slug] = result[slug] + row.minutes
+        for row in self._report_minutes(qs, 'ticket__contact__slug'):
+            result[row['ticket__contact__slug']] = self._minutes(row)
         return result
 
     def report_time_by_ticket(self, user, day):
         """Group time by ticket for a user for a day.
 
         Return an ordered dictionary containing analysis of chargeable,
-        non-chargeable and fixed price time.
+        non-chargeable and fixed price time.  The most recent ticket is
+        first.
 
         """
-        qs = TimeRecord.objects.filter(
-            user=user,
-            date_started=day,
+        qs = self._report(day, day, user).annotate(
+            category=models.Case(
+                models.When(
+                    ticket__fixed_price=True,
+                    then=models.Value(TimeRecord.FIXED_PRICE),
+                ),
+                models.When(
+                    billable=True,
+                    then=models.Value(TimeRecord.CHARGE),
+                ),
+                default=models.Value(TimeRecord.NON_CHARGE),
+                output_field=models.CharField(),
+            )
+        )
+        qs = self._report_minutes(
+            qs, 'ticket', 'category', last_start_time=Max('start_time')
         ).order_by(
-            '-start_time',
+            '-last_start_time',
         )
         result = collections.OrderedDict()
         for row in qs:
-            if row.is_complete:
-                ticket = row.ticket
-                ticket_pk = row.ticket.pk
-                if not ticket_pk in result:
-                    result[ticket_pk] = {
-                        TimeRecord.CHARGE: 0,
-                        TimeRecord.FIXED_PRICE: 0,
-                        TimeRecord.NON_CHARGE: 0,
-                    }
-                data = result[ticket_pk]
-                minutes = row.minutes
-                if ticket.fixed_price:
-                    data[TimeRecord.FIXED_PRICE] = data[
-                        TimeRecord.FIXED_PRICE
-                    ] + minutes
-                elif row.billable:
-                    data[TimeRecord.CHARGE] = data[
-                        TimeRecord.CHARGE
-                    ] + minutes
-                else:
-                    data[TimeRecord.NON_CHARGE] = data[
-                        TimeRecord.NON_CHARGE
-                    ] + minutes
-                result[ticket_pk] = data
+            ticket_pk = row['ticket']
+            if not ticket_pk in result:
+                result[ticket_pk] = {
+                    TimeRecord.CHARGE: 0,
+                    TimeRecord.FIXED_PRICE: 0,
+                    TimeRecord.NON_CHARGE: 0,
+                }
+            data = result[ticket_pk]
+            data[row['category']] = data[row['category']] + self._minutes(row)
         return result
 
     def report_time_by_user(self, from_date, to_date):
-        qs = TimeRecord.objects.filter(
-            date_started__gte=from_date,
-            date_started__lte=to_date,
-        )
+        qs = self._report(from_date, to_date)
         result = {}
-        for row in qs:
-            if row.is_complete:
-                user_name = row.user.username
-                if not user_name in result:
-                    result[user_name] = 0
-                result[user_name] = result[user_name] + row.minutes
+        for row in self._report_minutes(qs, 'user__username'):
+            result[row['user__username']] = self._minutes(row)
         return result
 
     def report_time_by_user_by_week_date(self, from_date, to_date, user):
+        """Time for each week (starting on a Sunday).
+
+        The database groups the time by day (Django does not have a week
+        function for a week starting on a Sunday), so we only add up (at
+        most) seven rows for each week.
+
+        """
         start_date = from_date + relativedelta(weekday=SU(-1))
         end_date = to_date + relativedelta(weekday=SU(1))
         result = collections.OrderedDict()
         for d in rrule(WEEKLY, dtstart=start_date, until=end_date):
             result[d.date()] = 0
-        qs = TimeRecord.objects.filter(
-            date_started__gte=from_date,
-            date_started__lte=to_date,
-            user=user,
-        )
-        for row in qs:
-            if row.is_complete:
-                item = row.date_started + relativedelta(weekday=SU(-1))
-                result[item] = result[item] + row.minutes
+        qs = self._report(from_date, to_date, user)
+        for row in self._report_minutes(qs, 'date_started'):
+            item = row['date_started'] + relativedelta(weekday=SU(-1))
+            result[item] = result[item] + self._minutes(row)
         return result
 
     def report_time_by_user_by_week(self, from_date, to_date, user):
@@ -655,6 +1110,26 @@ class TimeRecordManager(models.Manager):
             tickets.add(x.ticket.pk)
         return Ticket.objects.filter(pk__in=tickets)
 
+    def _to_invoice(self, iteration_end):
+        return self.model.objects.filter(
+            date_started__lte=iteration_end,
+            invoice_line__isnull=True,
+            billable=True,
+        ).exclude(
+            ticket__fixed_price=True,
+        )
+
+    def contacts_to_invoice(self, iteration_end):
+        """Primary key of each contact with time records to invoice."""
+        return self._to_invoice(
+            iteration_end
+        ).order_by(
+            'ticket__contact',
+        ).values_list(
+            'ticket__contact',
+            flat=True,
+        ).distinct()
+
     def to_invoice(self, contact, iteration_end):
         """
         Find time records:
@@ -663,19 +1138,39 @@ class TimeRecordManager(models.Manager):
         - which are chargeable
         - which are not fixed price
         """
-        return self.model.objects.filter(
+        return self._to_invoice(
+            iteration_end
+        ).filter(
             ticket__contact=contact,
-            date_started__lte=iteration_end,
-            invoice_line__isnull=True,
-            billable=True,
-        ).exclude(
-            ticket__fixed_price=True,
         ).order_by(
             'ticket__pk',
             'date_started',
             'start_time',
         )
 
+    def to_invoice_for_update(self, contact, iteration_end):
+        """Lock the time records to invoice (until the end of the transaction).
+
+        Time records locked by another transaction are skipped (if the
+        database supports ``SKIP LOCKED``), so workers invoicing at the same
+        time can't add the same time record to two invoices.
+
+        The locking query does not join to any other table, so only the time
+        records are locked (not the tickets).
+
+        """
+        qs = self.model.objects.filter(
+            invoice_line__isnull=True,
+            pk__in=self.to_invoice(contact, iteration_end).values('pk'),
+        ).order_by(
+            'ticket_id',
+            'date_started',
+            'start_time',
+        )
+        if connection.features.has_select_for_update_skip_locked:
+            return qs.select_for_update(skip_locked=True)
+        return qs.select_for_update()
+
 
 class TimeRecord(TimeStampedModel):
     """Simple time recording"""
@@ -688,15 +1183,18 @@ class TimeRecord(TimeStampedModel):
     user = models.ForeignKey(settings.AUTH_USER_MODEL)
     title = models.CharField(max_length=100)
     description = models.TextField(blank=True, null=True)
-    date_started = models.DateField()
+    date_started = models.DateField(db_index=True)
     start_time = models.TimeField()
     end_time = models.TimeField(blank=True, null=True)
     billable = models.BooleanField(default=False)
     invoice_line = models.OneToOneField(InvoiceLine, blank=True, null=True)
     time_code = models.ForeignKey(TimeCode, blank=True, null=True)
+    # set by 'save' (empty if the time record is not complete)
+    duration_seconds = models.IntegerField(blank=True, null=True)
     objects = TimeRecordManager()
 
     class Meta:
+        index_together = ('user', 'date_started')
         ordering = ['-date_started', '-start_time']
         verbose_name = 'Time record'
         verbose_name_plural = 'Time records'
@@ -779,6 +1277,44 @@ class TimeRecord(TimeStampedModel):
         td = self.delta()
         return td.days * 1440 + td.seconds / 60
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        obj = super().from_db(db, field_names, values)
+        # so we can find the time summary (in the cache) for the old values
+        obj._loaded_values = dict(zip(field_names, values))
+        return obj
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            TimeRecordDay.objects.remove(self.pk)
+            result = super().delete(*args, **kwargs)
+        return result
+
+    def save(self, *args, **kwargs):
+        self.duration_seconds = self._calculate_duration_seconds()
+        with transaction.atomic():
+            if self.pk:
+                TimeRecordDay.objects.remove(self.pk)
+            super().save(*args, **kwargs)
+            TimeRecordDay.objects.add(self.pk)
+
+    def _calculate_duration_seconds(self):
+        if not self.is_complete:
+            return None
+        # convert the values in the same way as the database
+        date_started = self._meta.get_field('date_started').to_python(
+            self.date_started
+        )
+        start_time = self._meta.get_field('start_time').to_python(
+            self.start_time
+        )
+        end_time = self._meta.get_field('end_time').to_python(self.end_time)
+        td = (
+            datetime.combine(date_started, end_time) -
+            datetime.combine(date_started, start_time)
+        )
+        return td.days * 86400 + td.seconds
+
     def stop(self, end_time=None):
         """Stop recording time on this record."""
         if not end_time:
@@ -798,3 +1334,344 @@ class TimeRecord(TimeStampedModel):
     user_can_edit = property(_user_can_edit)
 
 reversion.register(TimeRecord)
+
+
+@receiver(post_delete, sender=TimeRecord)
+@receiver(post_save, sender=TimeRecord)
+def time_record_time_summary_cache_delete(sender, instance, **kwargs):
+    """Remove the time summary (user and day) and dashboard from the cache.
+
+    The keys are removed after the commit, so another request cannot cache
+    the old totals before the new ones can be seen.
+
+    """
+    field = instance._meta.get_field('date_started')
+    keys = set([time_summary_cache_key(
+        instance.user_id,
+        field.to_python(instance.date_started),
+    )])
+    loaded = getattr(instance, '_loaded_values', None)
+    if loaded and 'user_id' in loaded and 'date_started' in loaded:
+        keys.add(time_summary_cache_key(
+            loaded['user_id'],
+            loaded['date_started'],
+        ))
+    keys.add(DASH_CACHE_KEY)
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+class TimeRecordDayManager(models.Manager):
+
+    def _sum(self, expression, **conditions):
+        return models.Sum(models.Case(
+            models.When(then=expression, **conditions),
+            default=models.Value(0),
+            output_field=models.IntegerField(),
+        ))
+
+    def _totals(self):
+        """Total the complete time records for each user, ticket and day.
+
+        The minutes for each time record are truncated (before they are
+        added up).
+
+        """
+        minutes = models.F('duration_seconds') / 60
+        return TimeRecord.objects.filter(
+            duration_seconds__isnull=False,
+        ).order_by().values(
+            'user',
+            'ticket',
+            'date_started',
+        ).annotate(
+            billable_minutes=self._sum(minutes, billable=True),
+            non_billable_minutes=self._sum(minutes, billable=False),
+        )
+
+    def _update(self, qs, sign):
+        """Add (``sign`` is 1) or remove (-1) the time for the time records.
+
+        The totals are updated using ``F()`` expressions, so two time records
+        can be saved at the same time.
+
+        """
+        qs = qs.filter(duration_seconds__isnull=False).values(
+            'billable',
+            'date_started',
+            'duration_seconds',
+            'ticket',
+            'user',
+        )
+        for row in qs:
+            obj, created = self.model.objects.get_or_create(
+                date=row['date_started'],
+                ticket_id=row['ticket'],
+                user_id=row['user'],
+            )
+            if row['billable']:
+                name = 'billable_minutes'
+            else:
+                name = 'non_billable_minutes'
+            self.model.objects.filter(pk=obj.pk).update(**{
+                name: models.F(name) + sign * (row['duration_seconds'] // 60)
+            })
+
+    def add(self, time_record_pk):
+        """Add the time from a time record to the totals for the day."""
+        self._update(TimeRecord.objects.filter(pk=time_record_pk), 1)
+
+    def remove(self, time_record_pk):
+        """Remove the time for a time record from the totals for the day.
+
+        The time record is locked, so it is only removed once.
+
+        """
+        self._update(
+            TimeRecord.objects.select_for_update().filter(pk=time_record_pk),
+            -1,
+        )
+
+    def rebuild(self):
+        """Replace the daily totals with totals from the time records."""
+        with transaction.atomic():
+            self.model.objects.all().delete()
+            self.model.objects.bulk_create([
+                self.model(
+                    billable_minutes=row['billable_minutes'],
+                    date=row['date_started'],
+                    non_billable_minutes=row['non_billable_minutes'],
+                    ticket_id=row['ticket'],
+                    user_id=row['user'],
+                )
+                for row in self._totals().iterator()
+            ], batch_size=500)
+        return self.model.objects.count()
+
+    def report_dash(self, from_date, to_date):
+        """Minutes for each user, contact (user) and charge / non-charge.
+
+        A row for each user, contact (user) and billable (``True`` or
+        ``False``).  There are no rows for zero minutes.
+
+        """
+        qs = self.model.objects.filter(
+            date__gte=from_date,
+            date__lte=to_date,
+        ).order_by().values(
+            'ticket__contact__user__username',
+            'user',
+            'user__username',
+        ).annotate(
+            billable=models.Sum('billable_minutes'),
+            non_billable=models.Sum('non_billable_minutes'),
+        )
+        result = []
+        for row in qs:
+            for billable, minutes in (
+                    (False, row.pop('non_billable')),
+                    (True, row.pop('billable'))):
+                if minutes:
+                    result.append(
+                        dict(row, billable=billable, minutes=minutes)
+                    )
+        return result
+
+    def totals(self, from_date, to_date):
+        """Minutes for each user and month.
+
+        The contact and fixed price are read from the ticket, so the totals
+        are correct if they are changed.
+
+        """
+        return self.model.objects.filter(
+            date__gte=from_date,
+            date__lte=to_date,
+        ).annotate(
+            month=TruncMonth('date'),
+        ).order_by().values(
+            'month',
+            'user',
+            'user__username',
+        ).annotate(
+            charge_minutes=self._sum(
+                models.F('billable_minutes'),
+                ticket__fixed_price=False,
+            ),
+            fixed_minutes=self._sum(
+                (
+                    models.F('billable_minutes') +
+                    models.F('non_billable_minutes')
+                ),
+                ticket__fixed_price=True,
+            ),
+            non_minutes=self._sum(
+                models.F('non_billable_minutes'),
+                ticket__fixed_price=False,
+            ),
+        )
+
+    def verify(self):
+        """Compare the daily totals with the time records.
+
+        Return a list of ``(key, stored, expected)`` for each difference,
+        where ``key`` is ``(user_pk, ticket_pk, date)`` and the totals are
+        ``(billable, non_billable)`` minutes.
+
+        """
+        names = ('billable_minutes', 'non_billable_minutes')
+        expected = {}
+        for row in self._totals().iterator():
+            key = (row['user'], row['ticket'], row['date_started'])
+            expected[key] = tuple(row[name] for name in names)
+        stored = {}
+        qs = self.model.objects.order_by().values(
+            'date', 'ticket', 'user', *names
+        )
+        for row in qs.iterator():
+            key = (row['user'], row['ticket'], row['date'])
+            stored[key] = tuple(row[name] for name in names)
+        result = []
+        empty = (0, 0)
+        for key in sorted(set(expected) | set(stored)):
+            totals = stored.get(key, empty)
+            if totals != expected.get(key, empty):
+                result.append((key, totals, expected.get(key, empty)))
+        return result
+
+
+class TimeRecordDay(models.Model):
+    """Time for a user and ticket on a day (totals from the time records).
+
+    Saving or deleting a time record updates the totals.  The minutes for
+    each time record are truncated (before they are added up), in the same
+    way as the reports.
+
+    The contact and fixed price are not stored, so the reports read them
+    from the ticket (and they can be changed without updating the totals).
+
+    """
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL)
+    ticket = models.ForeignKey(Ticket)
+    date = models.DateField()
+    billable_minutes = models.IntegerField(default=0)
+    non_billable_minutes = models.IntegerField(default=0)
+    objects = TimeRecordDayManager()
+
+    class Meta:
+        ordering = ['date']
+        unique_together = ('user', 'ticket', 'date')
+        verbose_name = 'Time record day'
+        verbose_name_plural = 'Time record days'
+
+    def __str__(self):
+        return '{} {} {}'.format(self.date, self.user.username, self.ticket.pk)
+
+
+class TimeSummaryMonthManager(models.Manager):
+
+    def _months(self, from_date, to_date):
+        result = []
+        month = from_date + relativedelta(day=1)
+        while month < to_date:
+            result.append(month)
+            month = month + relativedelta(months=+1)
+        return result
+
+    def closed(self, from_date, to_date):
+        """Minutes for each user and month from the snapshots.
+
+        ``to_date`` is the first day of the first month which is not closed.
+        Closed months which do not have a snapshot are stored first (a month
+        with no time for any user is stored as a row without a user).
+
+        """
+        qs = self.model.objects.filter(month__gte=from_date, month__lt=to_date)
+        stored = set(qs.values_list('month', flat=True).distinct())
+        missing = [
+            month for month in self._months(from_date, to_date)
+            if not month in stored
+        ]
+        if missing:
+            # only read the time records for the missing months
+            rows = self.totals(from_date, to_date).filter(functools.reduce(
+                operator.or_,
+                [
+                    models.Q(
+                        date__gte=month,
+                        date__lt=month + relativedelta(months=+1),
+                    )
+                    for month in missing
+                ],
+            ))
+            snapshots = [
+                self.model(
+                    charge_minutes=row['charge_minutes'],
+                    fixed_minutes=row['fixed_minutes'],
+                    month=row['month'],
+                    non_minutes=row['non_minutes'],
+                    user_id=row['user'],
+                )
+                for row in rows
+            ]
+            # an empty marker for a month with no time, so we don't check
+            # the time records for the month again
+            months = set(x.month for x in snapshots)
+            snapshots = snapshots + [
+                self.model(
+                    charge_minutes=0,
+                    fixed_minutes=0,
+                    month=month,
+                    non_minutes=0,
+                    user=None,
+                )
+                for month in missing if not month in months
+            ]
+            if snapshots:
+                try:
+                    with transaction.atomic():
+                        self.model.objects.bulk_create(snapshots)
+                except IntegrityError:
+                    # another process stored the snapshot
+                    pass
+        return qs.filter(user__isnull=False).order_by().values(
+            'charge_minutes',
+            'fixed_minutes',
+            'month',
+            'non_minutes',
+            'user__username',
+        )
+
+    def totals(self, from_date, to_date):
+        """Minutes for each user and month (see ``TimeRecordDay``)."""
+        return TimeRecordDay.objects.totals(from_date, to_date)
+
+
+class TimeSummaryMonth(models.Model):
+    """Time for a user for a closed month (a snapshot, so never updated).
+
+    ``month`` is the first day of the month.  A row without a ``user`` marks
+    a closed month with no time.  ``unique_together`` does not stop two rows
+    without a ``user`` (``NULL`` is never equal), so migration ``0019`` adds
+    a partial unique index for the markers.
+
+    """
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True)
+    month = models.DateField()
+    charge_minutes = models.IntegerField()
+    fixed_minutes = models.IntegerField()
+    non_minutes = models.IntegerField()
+    objects = TimeSummaryMonthManager()
+
+    class Meta:
+        ordering = ['month']
+        unique_together = ('user', 'month')
+        verbose_name = 'Time summary month'
+        verbose_name_plural = 'Time summary months'
+
+    def __str__(self):
+        return '{} {}'.format(
+            self.month.strftime('%Y-%m'),
+            self.user.username if self.user else '(no time)',
+        )
@@ -1,20 +1,30 @@
 # -*- encoding: utf-8 -*-
 import collections
 import csv
+import itertools
 
 from datetime import date
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
+from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
 from reportlab import platypus
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
 
-from crm.models import Ticket
 from report.pdf import MyReport
 from report.service import ReportMixin
-from .models import TimeRecord
-from .service import format_minutes, InvoiceError
+from .models import (
+    DASH_CACHE_KEY,
+    DASH_CACHE_TIMEOUT,
+    TIME_SUMMARY_CACHE_TIMEOUT,
+    time_summary_cache_key,
+    TimeRecord,
+    TimeRecordDay,
+    TimeSummaryMonth,
+)
+from .service import format_minutes, InvoiceError, InvoiceTickets
 
 
 def _analysis(analysis):
@@ -28,94 +38,193 @@ def _analysis(analysis):
     }
 
 
-def time_summary(user, days=None):
-    """Time summary for a user.
+def _time_summary_by_day(user, from_date, to_date):
+    """Group the time for a user by day and ticket (most recent first).
+
+    A single query (with the ticket, contact and user) for the date range.
 
     """
-    if not days:
-        days = 4
-    # list of the last 10 days
-    date_list = []
-    d = timezone.now().date()
-    for i in range(0, 31):
-        date_list.append(d)
+    qs = TimeRecord.objects.filter(
+        date_started__gte=from_date,
+        date_started__lte=to_date,
+        duration_seconds__isnull=False,
+        user=user,
+    ).select_related(
+        'ticket__contact__user',
+    ).order_by(
+        '-date_started',
+        '-start_time',
+    )
+    result = collections.OrderedDict()
+    for row in qs:
+        if not row.date_started in result:
+            result[row.date_started] = collections.OrderedDict()
+        tickets = result[row.date_started]
+        ticket = row.ticket
+        if not ticket.pk in tickets:
+            tickets[ticket.pk] = (ticket, {
+                TimeRecord.CHARGE: 0,
+                TimeRecord.FIXED_PRICE: 0,
+                TimeRecord.NON_CHARGE: 0,
+            })
+        analysis = tickets[ticket.pk][1]
+        if ticket.fixed_price:
+            category = TimeRecord.FIXED_PRICE
+        elif row.billable:
+            category = TimeRecord.CHARGE
+        else:
+            category = TimeRecord.NON_CHARGE
+        analysis[category] = analysis[category] + row.minutes
+    return result
+
+
+def time_summary_for_dash():
+    """Time for all users for the last month (for the dashboard charts).
+
+    A list of rows from ``TimeRecordDayManager.report_dash``.  The list is
+    shared by all users, so it is cached.
+
+    """
+    result = cache.get(DASH_CACHE_KEY)
+    if result is None:
+        to_date = timezone.now()
+        from_date = to_date + relativedelta(months=-1)
+        result = TimeRecordDay.objects.report_dash(from_date, to_date)
+        cache.set(
+            DASH_CACHE_KEY,
+            result,
+            getattr(
+                settings,
+                'INVOICE_DASH_CACHE_TIMEOUT',
+                DASH_CACHE_TIMEOUT,
+            ),
+        )
+    return result
+
+
+def _time_summary_tickets(user, from_date, to_date):
+    """Tickets for each day (most recent first) using the cache.
+
+    The time for each day is cached (even if the user did not work on that
+    day).  Saving or deleting a time record removes the day from the cache
+    (see ``time_summary_cache_key``).  The days which are not in the cache
+    are read in a single query.
+
+    """
+    days = []
+    d = to_date
+    while d >= from_date:
+        days.append(d)
         d = d + relativedelta(days=-1)
-    # find three days where I worked and display the time summary
-    count = 0
-    report = collections.OrderedDict()
-    for d in date_list:
-        data = TimeRecord.objects.report_time_by_ticket(user, d)
-        if data:
-            summary = {}
+    keys = {time_summary_cache_key(user.pk, d): d for d in days}
+    result = {
+        keys[key]: tickets for key, tickets in cache.get_many(keys).items()
+    }
+    missing = [d for d in days if not d in result]
+    if missing:
+        data = _time_summary_by_day(user, min(missing), max(missing))
+        to_cache = {}
+        for d in missing:
             tickets = []
-            total_charge = total_fixed = total_non = 0
-            for ticket_pk, analysis in data.items():
-                ticket = Ticket.objects.get(pk=ticket_pk)
+            for ticket, analysis in data.get(d, {}).values():
                 tickets.append({
                     'pk': ticket.pk,
                     'description': ticket.title,
                     'contact': ticket.contact.get_full_name,
                     'user_name': ticket.contact.user.username,
-                    'analysis': _analysis(analysis),
+                    'analysis': analysis,
                 })
-                total_charge = total_charge + analysis[TimeRecord.CHARGE]
-                total_fixed = total_fixed + analysis[TimeRecord.FIXED_PRICE]
-                total_non = total_non + analysis[TimeRecord.NON_CHARGE]
-            total = total_charge + total_fixed + total_non
-            summary['tickets'] = tickets
-            summary['total'] = total
-            summary['total_format'] = format_minutes(total)
-            summary['total_charge'] = total_charge
-            summary['total_charge_format'] = format_minutes(total_charge)
-            summary['total_fixed'] = total_fixed
-            summary['total_fixed_format'] = format_minutes(total_fixed)
-            summary['total_non'] = total_non
-            summary['total_non_format'] = format_minutes(total_non)
-            report[d] = summary
-            count = count + 1
+            result[d] = tickets
+            to_cache[time_summary_cache_key(user.pk, d)] = tickets
+        cache.set_many(
+            to_cache,
+            getattr(
+                settings,
+                'INVOICE_TIME_SUMMARY_CACHE_TIMEOUT',
+                TIME_SUMMARY_CACHE_TIMEOUT,
+            ),
+        )
+    return collections.OrderedDict((d, result[d]) for d in days)
+
+
+def time_summary(user, days=None):
+    """Time summary for a user.
+
+    """
+    if not days:
+        days = 4
+    # the last 31 days
+    to_date = timezone.now().date()
+    from_date = to_date + relativedelta(days=-30)
+    data = _time_summary_tickets(user, from_date, to_date)
+    # find the days where I worked and display the time summary
+    report = collections.OrderedDict()
+    for d, tickets in data.items():
+        if not tickets:
+            continue
+        summary = {}
+        ticket_list = []
+        total_charge = total_fixed = total_non = 0
+        for ticket in tickets:
+            analysis = ticket['analysis']
+            ticket_list.append(dict(ticket, analysis=_analysis(analysis)))
+            total_charge = total_charge + analysis[TimeRecord.CHARGE]
+            total_fixed = total_fixed + analysis[TimeRecord.FIXED_PRICE]
+            total_non = total_non + analysis[TimeRecord.NON_CHARGE]
+        total = total_charge + total_fixed + total_non
+        summary['tickets'] = ticket_list
+        summary['total'] = total
+        summary['total_format'] = format_minutes(total)
+        summary['total_charge'] = total_charge
+        summary['total_charge_format'] = format_minutes(total_charge)
+        summary['total_fixed'] = total_fixed
+        summary['total_fixed_format'] = format_minutes(total_fixed)
+        summary['total_non'] = total_non
+        summary['total_non_format'] = format_minutes(total_non)
+        report[d] = summary
         # maximum of 5 days
-        if count > days:
+        if len(report) > days:
             break
     return report
 
 
 def time_summary_by_user(today=None):
+    """Time for each user by month.
+
+    Closed months are read from the snapshots, so only the previous month
+    is calculated from the time records.
+
+    """
     result = {}
     if today is None:
         today = date.today()
-    # 12 whole months
+    # 24 whole months
     from_date = today + relativedelta(months=-24, day=1)
     to_date = today + relativedelta(day=1, days=-1)
-    qs = TimeRecord.objects.filter(
-        date_started__gte=from_date,
-        date_started__lte=to_date,
+    closed_date = today + relativedelta(months=-1, day=1)
+    rows = itertools.chain(
+        TimeSummaryMonth.objects.closed(from_date, closed_date),
+        TimeSummaryMonth.objects.totals(closed_date, to_date),
     )
-    for row in qs:
-        if row.is_complete:
-            user_name = row.user.username
-            if not user_name in result:
-                result[user_name] = collections.OrderedDict()
-                x = from_date
-                while x < to_date:
-                    key = x.strftime('%Y-%m')
-                    result[user_name][key] = {
-                        'label': x.strftime('%b'),
-                        'month': x.month,
-                        'year': x.year,
-                        'charge_minutes': 0,
-                        'fixed_minutes': 0,
-                        'non_minutes': 0,
-                    }
-                    x = x + relativedelta(months=+1, day=1)
-            key = row.date_started.strftime('%Y-%m')
-            data = result[user_name][key]
-            minutes = int(row.minutes)
-            if row.ticket.fixed_price:
-                data['fixed_minutes'] = data['fixed_minutes'] + minutes
-            elif row.billable:
-                data['charge_minutes'] = data['charge_minutes'] + minutes
-            else:
-                data['non_minutes'] = data['non_minutes'] + minutes
+    for row in rows:
+        user_name = row['user__username']
+        if not user_name in result:
+            result[user_name] = collections.OrderedDict()
+            x = from_date
+            while x < to_date:
+                key = x.strftime('%Y-%m')
+                result[user_name][key] = {
+                    'label': x.strftime('%b'),
+                    'month': x.month,
+                    'year': x.year,
+                    'charge_minutes': 0,
+                    'fixed_minutes': 0,
+                    'non_minutes': 0,
+                }
+                x = x + relativedelta(months=+1, day=1)
+        data = result[user_name][row['month'].strftime('%Y-%m')]
+        for name in ('charge_minutes', 'fixed_minutes', 'non_minutes'):
+            data[name] = data[name] + row[name]
     return result
 
 
@@ -143,10 +252,9 @@ class ReportInvoiceTimeAnalysis(MyReport):
         ))
         doc.build(elements)
 
-    def _get_ticket_description(self, pk):
+    def _get_ticket_description(self, tickets, pk):
         if pk:
-            ticket = Ticket.objects.get(pk=pk)
-            result = '{}, {}'.format(ticket.pk, ticket.title)
+            result = '{}, {}'.format(pk, tickets.title(pk))
         else:
             result = ''
         return result
@@ -189,6 +297,7 @@ class ReportInvoiceTimeAnalysis(MyReport):
             self._bold('Net'),
         ]]
         analysis = invoice.time_analysis()
+        ticket_lookup = InvoiceTickets(invoice)
         lines = []
         for user, tickets in analysis.items():
             first_loop = True
@@ -212,7 +321,11 @@ class ReportInvoiceTimeAnalysis(MyReport):
 
                 lines.append([
                     user_name,
-                    self._para(self._get_ticket_description(ticket_pk)),
+                    self._para(
+                        self._get_ticket_description(
+                            ticket_lookup, ticket_pk
+                        )
+                    ),
                     self._format_time(user, quantity),
                     net,
                 ])
@@ -240,19 +353,37 @@ class ReportInvoiceTimeAnalysis(MyReport):
         )
 
 
+class Echo:
+    """A file-like object which returns the value (rather than storing it).
+
+    For use with ``csv.writer`` when streaming a response, see
+    https://docs.djangoproject.com/en/1.11/howto/outputting-csv/
+
+    """
+
+    def write(self, value):
+        return value
+
+
 class ReportInvoiceTimeAnalysisCSV(MyReport):
 
-    def report(self, invoice, user, response):
+    def stream(self, invoice):
+        """CSV lines for a ``StreamingHttpResponse``.
+
+        The invoice is checked before the lines are returned.  The lines are
+        produced (by a generator) as the response is sent.
+
+        """
         self._is_valid(invoice, raise_exception=True)
-        csv_writer = csv.writer(response, dialect='excel')
-        rows = self._produce_csv_rows(invoice)
-        for row in rows:
+        csv_writer = csv.writer(Echo(), dialect='excel')
+        return (
             csv_writer.writerow(row)
+            for row in self._produce_csv_rows(invoice)
+        )
 
-    def _get_ticket_description(self, pk):
+    def _get_ticket_description(self, tickets, pk):
         if pk:
-            ticket = Ticket.objects.get(pk=pk)
-            result = ticket.title
+            result = tickets.title(pk)
         else:
             result = ''
         return result
@@ -277,11 +408,9 @@ class ReportInvoiceTimeAnalysisCSV(MyReport):
             return result
 
     def _produce_csv_rows(self, invoice):
-        """ Create rows for analysis csv """
-        rows = []
-
+        """ Create rows for analysis csv (a generator) """
         # invoice line header
-        rows.append([
+        yield [
             'Invoice Number',
             'Invoice Date',
             'Client Number',
@@ -294,29 +423,29 @@ class ReportInvoiceTimeAnalysisCSV(MyReport):
             'End Date',
             'Hours',
             'Net',
-        ])
-
+        ]
+        contact = invoice.contact
+        invoice_columns = [
+            invoice.invoice_number,
+            invoice.invoice_date,
+            contact.pk,
+            contact.get_full_name,
+            contact.hourly_rate,
+        ]
         analysis = invoice.time_analysis()
+        ticket_lookup = InvoiceTickets(invoice)
         for user, tickets in analysis.items():
             total_net = Decimal()
             total_quantity = Decimal()
             for ticket_pk, totals in tickets.items():
-                ticket_title = ""
-
-                if ticket_pk:
-                    ticket = Ticket.objects.get(pk=ticket_pk)
-                    ticket_title = ticket.title
+                ticket_title = self._get_ticket_description(
+                    ticket_lookup, ticket_pk
+                )
                 net = totals['net']
                 total_net = total_net + net
                 quantity = totals['quantity']
                 total_quantity = total_quantity + quantity
-
-                rows.append([
-                    invoice.invoice_number,
-                    invoice.invoice_date,
-                    invoice.contact.pk,
-                    invoice.contact.get_full_name,
-                    invoice.contact.hourly_rate,
+                yield invoice_columns + [
                     user,
                     ticket_pk,
                     ticket_title,
@@ -324,13 +453,8 @@ class ReportInvoiceTimeAnalysisCSV(MyReport):
                     totals['end_date'],
                     quantity,
                     net,
-                ])
-            rows.append([
-                invoice.invoice_number,
-                invoice.invoice_date,
-                invoice.contact.pk,
-                invoice.contact.get_full_name,
-                invoice.contact.hourly_rate,
+                ]
+            yield invoice_columns + [
                 user,
                 None,
                 "Total",
@@ -338,9 +462,7 @@ class ReportInvoiceTimeAnalysisCSV(MyReport):
                 None,
                 total_quantity,
                 total_net,
-            ])
-
-        return rows
+            ]
 
 
 class TimeSummaryByUserReport(ReportMixin):
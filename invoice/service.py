@@ -1,18 +1,29 @@
 # -*- encoding: utf-8 -*-
-import io
+import copy
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
 
 from datetime import date
 from decimal import Decimal
 
 from django.apps import apps
 from django.conf import settings
-from django.core.files.base import ContentFile
-from django.db import transaction
+from django.core.cache import caches
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.db import connections, transaction
+from django.db.models import Case, IntegerField, Q, Value, When
 
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
 from reportlab import platypus
 
+from crm.models import Ticket
 from finance.models import VatSettings
 from report.pdf import MyReport, NumberedCanvas
 from .models import (
@@ -20,11 +31,58 @@ from .models import (
     InvoiceContact,
     InvoiceError,
     InvoiceLine,
+    InvoicePrintJob,
     InvoiceSettings,
     TimeRecord,
 )
 
 
+logger = logging.getLogger(__name__)
+
+
+class InvoicePdfFile(TemporaryUploadedFile):
+    """A temporary file for an invoice PDF in ``folder``.
+
+    ``TemporaryUploadedFile`` creates the file in ``FILE_UPLOAD_TEMP_DIR``,
+    which may be on a different volume to the store.
+
+    """
+
+    def __init__(self, name, folder):
+        file = tempfile.NamedTemporaryFile(
+            prefix='.', suffix='.upload', dir=folder
+        )
+        super(TemporaryUploadedFile, self).__init__(
+            file, name, 'application/pdf', None, None
+        )
+
+
+def _create_pdf(invoice_pk):
+    """Create the PDF for an invoice (in a worker process).
+
+    Return the result as a ``dict``, so one invoice can fail without
+    stopping the others.
+
+    """
+    start = time.time()
+    error = file_name = None
+    try:
+        file_name = InvoicePrint().create_pdf_for_invoice(invoice_pk)
+    except InvoiceError as e:
+        error = str(e)
+    except Exception as e:
+        logger.exception('Cannot create the PDF for invoice {}'.format(
+            invoice_pk
+        ))
+        error = str(e)
+    return {
+        'error': error,
+        'file_name': file_name,
+        'pk': invoice_pk,
+        'seconds': time.time() - start,
+    }
+
+
 def format_minutes(minutes):
     """Convert minutes into formatted hours and minutes.
 
@@ -40,27 +98,57 @@ def format_minutes(minutes):
 class InvoiceCreate(object):
     """ Create invoices for outstanding time records """
 
+    # maximum number of time records to link in a single 'UPDATE'
+    BATCH_SIZE = 500
+
     def _add_time_records(self, user, invoice, time_records):
-        """Add time records to a draft invoice."""
+        """Add time records to a draft invoice.
+
+        The invoice lines are calculated in memory, created using
+        ``bulk_create`` and then linked to the time records with an
+        ``UPDATE ... CASE`` for each batch.
+
+        """
+        time_records = list(time_records)
+        if not time_records:
+            return
         invoice_settings = InvoiceSettings.objects.settings()
         vat_settings = VatSettings.objects.settings()
-        for tr in time_records:
-            contact = invoice.contact
-            invoice_contact = InvoiceContact.objects.get(contact=contact)
+        invoice_contact = InvoiceContact.objects.get(contact=invoice.contact)
+        line_numbers = invoice.reserve_line_numbers(len(time_records))
+        lines = []
+        for line_number, tr in zip(line_numbers, time_records):
             invoice_line = InvoiceLine(
                 user=user,
                 invoice=invoice,
-                line_number=invoice.get_next_line_number(),
+                line_number=line_number,
                 product=invoice_settings.time_record_product,
                 quantity=tr.invoice_quantity,
                 price=invoice_contact.hourly_rate,
                 units='hours',
                 vat_code=vat_settings.standard_vat_code,
             )
-            invoice_line.save()
-            # link time record to invoice line
-            tr.invoice_line = invoice_line
-            tr.save()
+            invoice_line.calculate()
+            lines.append(invoice_line)
+        InvoiceLine.objects.bulk_create(lines, batch_size=self.BATCH_SIZE)
+        # 'bulk_create' only sets the primary key when using PostgreSQL
+        line_pks = dict(InvoiceLine.objects.filter(
+            invoice=invoice,
+            line_number__range=(line_numbers[0], line_numbers[-1]),
+        ).values_list('line_number', 'pk'))
+        # link time records to invoice lines
+        for start in range(0, len(time_records), self.BATCH_SIZE):
+            batch = time_records[start:start + self.BATCH_SIZE]
+            whens = []
+            for line_number, tr in zip(line_numbers[start:], batch):
+                tr.invoice_line_id = line_pks[line_number]
+                whens.append(When(pk=tr.pk, then=Value(tr.invoice_line_id)))
+            TimeRecord.objects.filter(
+                pk__in=[tr.pk for tr in batch]
+            ).update(
+                invoice_line=Case(*whens, output_field=IntegerField())
+            )
+        invoice.update_totals()
 
     def _is_valid(self, contact, time_records, raise_exception=None):
         result = []
@@ -98,19 +186,28 @@ class InvoiceCreate(object):
     def create(self, user, contact, iteration_end):
         """ Create invoices from time records """
         invoice = None
-        time_records = TimeRecord.objects.to_invoice(contact, iteration_end)
-        self._is_valid(contact, time_records, raise_exception=True)
         with transaction.atomic():
-            if time_records.count():
-                next_number = Invoice.objects.next_number()
+            time_records = list(TimeRecord.objects.to_invoice_for_update(
+                contact,
+                iteration_end,
+            ))
+            self._is_valid(contact, time_records, raise_exception=True)
+            if time_records:
+                # the time records are locked by this transaction, so the
+                # (negative) primary key of the first one is a unique
+                # temporary number until we allocate the invoice number
                 invoice = Invoice(
-                    number=next_number,
+                    number=-time_records[0].pk,
                     invoice_date=date.today(),
                     contact=contact,
                     user=user,
                 )
                 invoice.save()
-            self._add_time_records(user, invoice, time_records)
+                self._add_time_records(user, invoice, time_records)
+                # allocate the number last, so the invoice sequence is only
+                # locked (for other workers) while we commit
+                invoice.number = Invoice.objects.next_number()
+                invoice.save(update_fields=['number'])
         return invoice
 
     def draft(self, contact, iteration_end):
@@ -128,12 +225,16 @@ class InvoiceCreate(object):
             raise InvoiceError(
                 "Time records can only be added to a draft invoice."
             )
-        time_records = TimeRecord.objects.to_invoice(
-            invoice.contact,
-            iteration_end,
-        )
-        self._is_valid(invoice.contact, time_records, raise_exception=True)
         with transaction.atomic():
+            time_records = list(TimeRecord.objects.to_invoice_for_update(
+                invoice.contact,
+                iteration_end,
+            ))
+            self._is_valid(
+                invoice.contact,
+                time_records,
+                raise_exception=True,
+            )
             self._add_time_records(user, invoice, time_records)
         return invoice
 
@@ -141,11 +242,224 @@ class InvoiceCreate(object):
 class InvoiceCreateBatch(object):
 
     def create(self, user, iteration_end):
-        """ Create invoices from time records """
+        """Create invoices for contacts with time records to invoice.
+
+        Returns a summary of the invoices created and the errors.
+
+        """
+        contact_pks = TimeRecord.objects.contacts_to_invoice(iteration_end)
+        return self.create_for_contacts(user, contact_pks, iteration_end)
+
+    def create_for_contacts(self, user, contact_pks, iteration_end):
+        """Create an invoice for each contact.
+
+        An error for one contact does not stop the invoices for the others
+        (each contact is invoiced in its own transaction).  Returns a
+        dictionary containing the primary key of each invoice and a list of
+        ``(contact_pk, message)`` for the errors.
+
+        """
+        result = dict(invoices=[], errors=[])
         invoice_create = InvoiceCreate()
         model = apps.get_model(settings.CONTACT_MODEL)
-        for contact in model.objects.all():
-            invoice_create.create(user, contact, iteration_end)
+        qs = model.objects.filter(pk__in=list(contact_pks)).order_by('pk')
+        for contact in qs:
+            try:
+                with transaction.atomic():
+                    invoice = invoice_create.create(
+                        user, contact, iteration_end
+                    )
+                if invoice:
+                    result['invoices'].append(invoice.pk)
+            except (InvoiceContact.DoesNotExist, InvoiceError) as e:
+                result['errors'].append((contact.pk, str(e)))
+            except Exception as e:
+                logger.exception(
+                    'Cannot create the invoice for contact {}'.format(
+                        contact.pk
+                    )
+                )
+                result['errors'].append((contact.pk, str(e)))
+        return result
+
+    def shards(self, iteration_end, count):
+        """Split the contacts to invoice into (up to) ``count`` lists."""
+        contact_pks = list(
+            TimeRecord.objects.contacts_to_invoice(iteration_end)
+        )
+        return [x for x in (contact_pks[i::count] for i in range(count)) if x]
+
+
+class InvoiceTickets:
+    """The tickets for the time records on an invoice.
+
+    Create one of these for each report.  The tickets (with the contact) are
+    read in a single query (the first time a ticket is needed).
+
+    """
+
+    def __init__(self, invoice):
+        self.invoice = invoice
+        self._tickets = None
+
+    def _load(self):
+        if self._tickets is None:
+            pks = TimeRecord.objects.filter(
+                invoice_line__invoice=self.invoice,
+            ).order_by().values('ticket')
+            qs = Ticket.objects.filter(pk__in=pks).select_related('contact')
+            self._tickets = {ticket.pk: ticket for ticket in qs}
+        return self._tickets
+
+    def get(self, pk):
+        """The ticket (or ``None`` if the ticket is not on the invoice)."""
+        return self._load().get(pk)
+
+    def title(self, pk):
+        ticket = self.get(pk)
+        if ticket:
+            result = ticket.title
+        else:
+            result = ''
+        return result
+
+
+class InvoiceLetterhead:
+    """The parts of the invoice PDF which are the same on every invoice.
+
+    Our name and address, phone number, VAT number, the header image and the
+    footer.  The paragraphs are parsed (and the image decoded) once for each
+    version of the settings.  ReportLab updates a flowable when it is drawn,
+    so each document gets a copy of the flowables (which shares the parsed
+    text and image data).
+
+    Each thread has its own letterhead.
+
+    """
+
+    # check the header image for changes (at most) this often
+    IMAGE_CHECK_SECONDS = 60
+
+    _local = threading.local()
+
+    def __init__(self, report, invoice_settings, vat_settings, header_image):
+        self.settings_key = self._settings_key(
+            invoice_settings, vat_settings, header_image
+        )
+        self.image_mtime = None
+        self.checked = time.time()
+        self.has_image = bool(header_image)
+        self._our_details = []
+        if header_image:
+            self.image_mtime = os.path.getmtime(header_image)
+            image = report._image(header_image)
+            # read the size and decode the image now, so the copies share
+            # the data (a JPEG is copied into the PDF, so is not decoded)
+            image.drawWidth
+            image._img
+            self._our_details.append(image)
+        self._our_details.append(report._para(
+            report._text_our_address(invoice_settings.name_and_address)
+        ))
+        self._our_details.append(report._bold(invoice_settings.phone_number))
+        if vat_settings.vat_number:
+            self._our_details.append(report._para(
+                report._text_our_vat_number(vat_settings.vat_number)
+            ))
+        self._footer = [
+            report._para(text)
+            for text in report._text_footer(invoice_settings.footer)
+        ]
+
+    @staticmethod
+    def _settings_key(invoice_settings, vat_settings, header_image):
+        return (
+            invoice_settings.name_and_address,
+            invoice_settings.phone_number,
+            invoice_settings.footer,
+            vat_settings.vat_number,
+            header_image,
+        )
+
+    @property
+    def key(self):
+        """The settings which are drawn on the letterhead."""
+        return self.settings_key + (self.image_mtime,)
+
+    def footer(self):
+        return [copy.copy(x) for x in self._footer]
+
+    def our_details(self):
+        return [copy.copy(x) for x in self._our_details]
+
+    @classmethod
+    def letterhead(cls, report, invoice_settings, vat_settings, header_image):
+        """The letterhead for the settings (create it if they have changed).
+
+        The header image is checked for changes every ``IMAGE_CHECK_SECONDS``.
+
+        """
+        key = cls._settings_key(invoice_settings, vat_settings, header_image)
+        result = getattr(cls._local, 'letterhead', None)
+        if result and result.settings_key == key and header_image:
+            if time.time() - result.checked > cls.IMAGE_CHECK_SECONDS:
+                if result.image_mtime == os.path.getmtime(header_image):
+                    result.checked = time.time()
+                else:
+                    result = None
+        if result is None or result.settings_key != key:
+            result = cls(report, invoice_settings, vat_settings, header_image)
+            cls._local.letterhead = result
+        return result
+
+
+class InvoiceLinesChunk(platypus.Flowable):
+    """A chunk of the invoice lines (after the first ``TABLE_CHUNK_ROWS``).
+
+    The header row is only drawn when the chunk starts at the top of a page,
+    so the chunks look the same as a single table with ``repeatRows=1``.  If
+    the chunk is split, the rest of the lines are a new chunk (at the top of
+    the next page).
+
+    """
+
+    def __init__(self, make_table, start, end):
+        super().__init__()
+        self.make_table = make_table
+        self.start = start
+        self.end = end
+        self.has_header = None
+        self.table = None
+
+    def _at_top(self):
+        frame = getattr(self, '_frame', None)
+        return bool(frame and frame._atTop)
+
+    def _table(self):
+        has_header = self._at_top()
+        if self.table is None or self.has_header != has_header:
+            self.has_header = has_header
+            self.table = self.make_table(self.start, self.end, has_header)
+        return self.table
+
+    def wrap(self, availWidth, availHeight):
+        return self._table().wrap(availWidth, availHeight)
+
+    def split(self, availWidth, availHeight):
+        result = self._table().split(availWidth, availHeight)
+        if len(result) == 2:
+            first = result[0]
+            lines = first._nrows - first.repeatRows
+            result = [
+                first,
+                InvoiceLinesChunk(
+                    self.make_table, self.start + lines, self.end
+                ),
+            ]
+        return result
+
+    def drawOn(self, canvas, x, y, _sW=0):
+        self.table.drawOn(canvas, x, y, _sW)
 
 
 class InvoicePrint(MyReport):
@@ -153,6 +467,41 @@ class InvoicePrint(MyReport):
     Write a PDF for an invoice which has already been created in the database.
     """
 
+    # draw the invoice lines in tables of (up to) this many rows
+    TABLE_CHUNK_ROWS = 20
+    # change this when the layout changes (so the PDFs are not re-used)
+    LAYOUT_VERSION = 1
+    # permissions for a PDF (if 'FILE_UPLOAD_PERMISSIONS' is not set)
+    PDF_PERMISSIONS = 0o644
+
+    def _fingerprint(self, invoice, invoice_lines, letterhead_key):
+        """A SHA-256 of everything which is drawn on the invoice PDF."""
+        data = [
+            self.LAYOUT_VERSION,
+            letterhead_key,
+            invoice.description,
+            invoice.invoice_number,
+            invoice.invoice_date,
+            self._text_invoice_address(invoice),
+            invoice.net,
+            invoice.vat,
+            invoice.gross,
+        ]
+        for line in invoice_lines:
+            title = None
+            if line.has_time_record:
+                title = line.timerecord.ticket.title
+            data.append([
+                line.line_number,
+                title,
+                self._get_invoice_line_description(line),
+                line.net,
+                line.vat_rate,
+                line.vat,
+            ])
+        content = json.dumps(data, default=str)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
     def _get_column_styles(self, column_widths):
         # style - add vertical grid lines
         style = []
@@ -166,41 +515,213 @@ class InvoicePrint(MyReport):
             )
         return style
 
-    def create_pdf(self, invoice, header_image):
-        self.is_valid(invoice, raise_exception=True)
+    def _pdf_file(self, invoice, invoice_filename):
+        """A temporary file for the PDF.
+
+        If the store is a folder, the temporary file is in the same folder as
+        the PDF, so the store can rename it into place (the PDF appears in
+        one step).  Other stores read the file in chunks.
+
+        The temporary file can only be read by us, so set the permissions of
+        the PDF (``FILE_UPLOAD_PERMISSIONS`` or ``PDF_PERMISSIONS``) before
+        it is moved.
+
+        """
+        storage = invoice.pdf.storage
+        name = invoice.pdf.field.generate_filename(invoice, invoice_filename)
+        try:
+            folder = os.path.dirname(storage.path(name))
+        except NotImplementedError:
+            result = TemporaryUploadedFile(
+                invoice_filename, 'application/pdf', None, None
+            )
+        else:
+            os.makedirs(folder, exist_ok=True)
+            result = InvoicePdfFile(invoice_filename, folder)
+        os.chmod(
+            result.temporary_file_path(),
+            settings.FILE_UPLOAD_PERMISSIONS or self.PDF_PERMISSIONS,
+        )
+        return result
+
+    def _write_pdf(self, invoice, invoice_lines, letterhead, invoice_filename):
+        """Write the PDF (to a temporary file) and save it to the invoice.
+
+        The storage moves the temporary file into place (see ``_pdf_file``)
+        rather than copy it in memory.
+
+        """
+        pdf = self._pdf_file(invoice, invoice_filename)
         # Create the document template
-        buff = io.BytesIO()
         doc = platypus.SimpleDocTemplate(
-            buff,
+            pdf,
             title=invoice.description,
             pagesize=A4
         )
-        invoice_settings = InvoiceSettings.objects.settings()
-        vat_settings = VatSettings.objects.settings()
         # Container for the 'Flowable' objects
         elements = []
-        elements.append(
-            self._table_header(
-                invoice,
-                invoice_settings,
-                vat_settings,
-                header_image
-            )
-        )
+        elements.append(self._table_header(invoice, letterhead))
         elements.append(platypus.Spacer(1, 12))
-        elements.append(self._table_lines(invoice))
+        elements = elements + self._table_lines(invoice_lines)
         elements.append(self._table_totals(invoice))
-        for text in self._text_footer(invoice_settings.footer):
-            elements.append(self._para(text))
+        elements = elements + letterhead.footer()
         # write the document to disk
-        doc.build(elements, canvasmaker=NumberedCanvas)
-        pdf = buff.getvalue()
-        buff.close()
+        try:
+            doc.build(elements, canvasmaker=NumberedCanvas)
+            pdf.size = pdf.tell()
+            pdf.seek(0)
+            invoice.pdf.save(invoice_filename, pdf, save=False)
+        finally:
+            pdf.close()
+
+    def _invoice_lines(self, invoice):
+        """The invoice lines with the time records and tickets (one query).
+
+        If a line doesn't have a time record, ``select_related`` remembers,
+        so ``has_time_record`` does not need another query.
+
+        """
+        return list(invoice.invoiceline_set.select_related(
+            'timerecord__ticket',
+        ))
+
+    def create_pdf(self, invoice, header_image):
+        """Create the PDF for the invoice.
+
+        If the invoice was set back to draft and nothing on it has changed
+        (see ``_fingerprint``), the previous PDF is used again.
+
+        """
+        invoice_lines = self._invoice_lines(invoice)
+        self.is_valid(
+            invoice,
+            raise_exception=True,
+            invoice_lines=invoice_lines,
+        )
+        letterhead = InvoiceLetterhead.letterhead(
+            self,
+            InvoiceSettings.objects.settings(),
+            VatSettings.objects.settings(),
+            header_image,
+        )
+        fingerprint = self._fingerprint(
+            invoice, invoice_lines, letterhead.key
+        )
         invoice_filename = '{}.pdf'.format(invoice.invoice_number)
-        invoice.pdf.save(invoice_filename, ContentFile(pdf))
+        previous_pdf = invoice.previous_pdf
+        if (previous_pdf and fingerprint == invoice.pdf_fingerprint and
+                previous_pdf.storage.exists(previous_pdf.name)):
+            invoice.pdf = previous_pdf.name
+        else:
+            self._write_pdf(
+                invoice, invoice_lines, letterhead, invoice_filename
+            )
+        invoice.pdf_fingerprint = fingerprint
+        invoice.previous_pdf = None
+        invoice.save()
         return invoice_filename
 
-    def is_valid(self, invoice, raise_exception=None):
+    def create_pdf_for_invoice(self, invoice_pk, header_image=None):
+        """Lock the invoice and create the PDF (if it is still a draft).
+
+        The lock is held until the PDF has been saved, so the storage write
+        and the change from draft happen once for each invoice.
+
+        Return the file name (or ``None`` if the invoice already has a PDF).
+
+        """
+        with transaction.atomic():
+            invoice = Invoice.objects.select_for_update().get(pk=invoice_pk)
+            if invoice.is_draft:
+                result = self.create_pdf(invoice, header_image)
+            else:
+                result = None
+        return result
+
+    def create_pdf_for_job(self, job_pk):
+        """Create the PDF for a print job.
+
+        Safe to run more than once (if the task is retried).  The job and the
+        invoice are locked, so the PDF is only created once.
+
+        If something unexpected goes wrong (storage, ReportLab or the
+        database), the transaction is rolled back, so the failure is saved
+        in a new transaction (rather than leaving the job pending).
+
+        """
+        try:
+            with transaction.atomic():
+                job = InvoicePrintJob.objects.select_for_update().get(
+                    pk=job_pk
+                )
+                if job.is_pending:
+                    try:
+                        # 'None' if an earlier run (or another job) created it
+                        self.create_pdf_for_invoice(job.invoice_id)
+                        job.status = InvoicePrintJob.COMPLETE
+                    except InvoiceError as e:
+                        job.status = InvoicePrintJob.FAILED
+                        job.message = str(e)
+                    job.save()
+        except Exception as e:
+            logger.exception('Cannot create the PDF for job {}'.format(job_pk))
+            InvoicePrintJob.objects.filter(
+                pk=job_pk,
+                status=InvoicePrintJob.PENDING,
+            ).update(
+                status=InvoicePrintJob.FAILED,
+                message=str(e) or e.__class__.__name__,
+            )
+            job = InvoicePrintJob.objects.get(pk=job_pk)
+        return job
+
+    def create_pdfs(self, invoice_pks, processes=None):
+        """Create the PDFs for the invoices using a pool of processes.
+
+        Keyword arguments:
+        processes -- the number of processes (``None`` for one per CPU)
+
+        Return a list of results (see ``_create_pdf``) in the same order as
+        ``invoice_pks``.
+
+        The pool closes the database connections, so it cannot be used inside
+        a transaction (``transaction.atomic``).
+
+        """
+        invoice_pks = list(invoice_pks)
+        if processes == 1 or len(invoice_pks) < 2:
+            return [_create_pdf(pk) for pk in invoice_pks]
+        if any(conn.in_atomic_block for conn in connections.all()):
+            raise InvoiceError(
+                "Cannot create the PDFs in a pool of processes inside a "
+                "transaction (use 'processes=1')"
+            )
+        # the workers are forked (so Django is already set up), but each
+        # process must open its own database and cache connections
+        connections.close_all()
+        for cache in caches.all():
+            cache.close()
+        context = multiprocessing.get_context('fork')
+        with context.Pool(processes) as pool:
+            result = pool.map(_create_pdf, invoice_pks, chunksize=1)
+        return result
+
+    def drafts(self, from_date=None, to_date=None, contact=None):
+        """Draft invoices (which do not have a PDF)."""
+        qs = Invoice.objects.current().filter(
+            Q(pdf='') | Q(pdf__isnull=True)
+        )
+        if from_date:
+            qs = qs.filter(invoice_date__gte=from_date)
+        if to_date:
+            qs = qs.filter(invoice_date__lte=to_date)
+        if contact:
+            qs = qs.filter(contact=contact)
+        return qs.order_by('number')
+
+    def is_valid(self, invoice, raise_exception=None, invoice_lines=None):
+        if invoice_lines is None:
+            invoice_lines = invoice.invoiceline_set.all()
         result = []
         if not invoice.has_lines:
             result.append(
@@ -213,7 +734,7 @@ class InvoicePrint(MyReport):
                 "create a PDF".format(invoice.invoice_number)
             )
         is_credit = invoice.is_credit
-        for line in invoice.invoiceline_set.all():
+        for line in invoice_lines:
             if not line.is_credit == is_credit:
                 if is_credit:
                     result.append(
@@ -259,32 +780,21 @@ class InvoicePrint(MyReport):
             ]
         )
 
-    def _table_header(
-            self, invoice, invoice_settings, vat_settings, header_image):
+    def _table_header(self, invoice, letterhead):
         """
         Create a table for the top section of the invoice (before the project
         description and invoice detail)
         """
         left = []
-        right = []
         # left hand content
         left.append(self._para(self._text_invoice_address(invoice)))
         left.append(platypus.Spacer(1, 12))
         left.append(self._table_invoice_detail(invoice))
-        # right hand content
-        if header_image:
-            right.append(self._image(header_image))
-        right.append(self._para(
-            self._text_our_address(invoice_settings.name_and_address)
-        ))
-        right.append(self._bold(invoice_settings.phone_number))
-        if vat_settings.vat_number:
-            right.append(self._para(
-                self._text_our_vat_number(vat_settings.vat_number)
-            ))
+        # right hand content (the same on every invoice)
+        right = letterhead.our_details()
         heading = [platypus.Paragraph(invoice.description, self.head_1)]
         # If the invoice has a logo, then the layout is different
-        if header_image:
+        if letterhead.has_image:
             data = [
                 [
                     heading + left,     # left
@@ -313,47 +823,84 @@ class InvoicePrint(MyReport):
             ]
         )
 
-    def _table_lines(self, invoice):
-        """ Create a table for the invoice lines """
+    def _table_lines(self, invoice_lines):
+        """ Create the tables for the invoice lines """
+        return self._table_lines_data(self._get_invoice_lines(invoice_lines))
+
+    def _table_lines_data(self, lines, chunk_rows=None):
+        """Create the tables for the rows from ``_get_invoice_lines``.
+
+        ReportLab measures every row which is left each time it splits a
+        table onto a new page, so the time for one large table grows with the
+        square of the number of rows.  We draw the lines in chunks of
+        ``TABLE_CHUNK_ROWS`` (see ``InvoiceLinesChunk``) so the time grows in
+        line with the number of rows.
+
+        """
+        if chunk_rows is None:
+            chunk_rows = self.TABLE_CHUNK_ROWS
         # invoice line header
-        data = [[
+        header = [
             None,
             self._para('Description'),
             'Net',
             '%VAT',
             'VAT',
             'Gross',
-        ]]
-        # lines
-        lines = self._get_invoice_lines(invoice)
-        # initial styles
-        style = [
-            #('BOX', (0, 0), (-1, -1), self.GRID_LINE_WIDTH, colors.gray),
-            ('LINEABOVE', (0, 0), (-1, 0), self.GRID_LINE_WIDTH, colors.gray),
-            ('VALIGN', (0, 0), (0, -1), 'TOP'),
-            ('ALIGN', (2, 0), (-1, -1), 'RIGHT'),
         ]
-        # style - add horizontal grid lines
-        for idx, line in enumerate(lines):
-            row_number = line[0]
-            if not row_number:
+        # column widths
+        column_widths = [30, 220, 50, 40, 50, 50]
+        column_styles = self._get_column_styles(column_widths)
+        # style - add horizontal grid lines (the row before each ticket)
+        line_below = set(
+            idx - 1 for idx, line in enumerate(lines) if not line[0]
+        )
+
+        def make_table(start, end, has_header):
+            """Create a table for ``lines[start:end]``."""
+            data = []
+            style = [
+                ('VALIGN', (0, 0), (0, -1), 'TOP'),
+                ('ALIGN', (2, 0), (-1, -1), 'RIGHT'),
+            ]
+            below = [idx - start for idx in range(start, end)
+                     if idx in line_below]
+            if has_header:
+                data.append(header)
+                style.append((
+                    'LINEABOVE',
+                    (0, 0),
+                    (-1, 0),
+                    self.GRID_LINE_WIDTH,
+                    colors.gray,
+                ))
+                # a line below the header (like a split table) if the first
+                # line (or the first line on this page) is for a ticket
+                below = [row + 1 for row in below]
+                if line_below & set([-1, start - 1]):
+                    below.insert(0, 0)
+            for row in below:
                 style.append((
                     'LINEBELOW',
-                    (0, idx),
-                    (-1, idx),
+                    (0, row),
+                    (-1, row),
                     self.GRID_LINE_WIDTH,
                     colors.gray)
                 )
-        # column widths
-        column_widths = [30, 220, 50, 40, 50, 50]
-        style = style + self._get_column_styles(column_widths)
-        # draw the table
-        return platypus.Table(
-            data + lines,
-            colWidths=column_widths,
-            repeatRows=1,
-            style=style,
-        )
+            # draw the table
+            return platypus.Table(
+                data + lines[start:end],
+                colWidths=column_widths,
+                repeatRows=len(data),
+                style=style + column_styles,
+            )
+
+        result = [make_table(0, min(chunk_rows, len(lines)), True)]
+        for start in range(chunk_rows, len(lines), chunk_rows):
+            result.append(InvoiceLinesChunk(
+                make_table, start, min(start + chunk_rows, len(lines))
+            ))
+        return result
 
     def _table_totals(self, invoice):
         """ Create a table for the invoice totals """
@@ -400,13 +947,13 @@ class InvoicePrint(MyReport):
         ))
         return '<br />'.join(result)
 
-    def _get_invoice_lines(self, invoice):
+    def _get_invoice_lines(self, invoice_lines):
         data = []
         ticket_pk = None
-        for line in invoice.invoiceline_set.all():
+        for line in invoice_lines:
             # ticket heading (do not repeat)
-            if line.has_time_record and ticket_pk != line.timerecord.ticket.pk:
-                ticket_pk = line.timerecord.ticket.pk
+            if line.has_time_record and ticket_pk != line.timerecord.ticket_id:
+                ticket_pk = line.timerecord.ticket_id
                 data.append([
                     None,
                     self._bold(line.timerecord.ticket.title),
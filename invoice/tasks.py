@@ -2,10 +2,14 @@
 import logging
 
 from celery import shared_task
+from datetime import datetime
+from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.utils import timezone
 
-from invoice.models import InvoiceUser
+from invoice.models import InvoiceBatch, InvoiceUser
 from invoice.report import time_summary
+from invoice.service import InvoiceCreateBatch, InvoicePrint
 from mail.service import queue_mail_message
 from mail.tasks import process_mail
 from report.models import ReportSchedule, ReportSpecification
@@ -14,6 +18,74 @@ from report.models import ReportSchedule, ReportSpecification
 logger = logging.getLogger(__name__)
 
 
+def _iteration_end(iteration_end):
+    return datetime.strptime(iteration_end, '%Y-%m-%d').date()
+
+
+@shared_task
+def invoice_batch(user_pk, iteration_end, shard_count=None):
+    """Create invoices for all contacts with time records to invoice.
+
+    The contacts are split into shards and each shard is invoiced by a
+    separate task.  The number of shards limits the number of tasks running
+    at the same time.  Each task adds the invoices it created (and any
+    errors) to the ``InvoiceBatch`` for the run, so we don't need a result
+    backend to collect them.
+
+    Keyword arguments:
+    iteration_end -- the date as a string e.g. ``'2017-01-31'``
+
+    Returns the primary key of the ``InvoiceBatch``.
+
+    """
+    if shard_count is None:
+        shard_count = getattr(settings, 'INVOICE_BATCH_SHARDS', 4)
+    shards = InvoiceCreateBatch().shards(
+        _iteration_end(iteration_end),
+        shard_count,
+    )
+    batch = InvoiceBatch.objects.create_batch(
+        get_user_model().objects.get(pk=user_pk),
+        _iteration_end(iteration_end),
+        len(shards),
+    )
+    logger.info('invoice_batch: {} shards (batch {})'.format(
+        len(shards), batch.pk
+    ))
+    for contact_pks in shards:
+        invoice_contacts.delay(user_pk, contact_pks, iteration_end, batch.pk)
+    return batch.pk
+
+
+@shared_task
+def invoice_contacts(user_pk, contact_pks, iteration_end, batch_pk=None):
+    user = get_user_model().objects.get(pk=user_pk)
+    result = InvoiceCreateBatch().create_for_contacts(
+        user,
+        contact_pks,
+        _iteration_end(iteration_end),
+    )
+    if batch_pk:
+        InvoiceBatch.objects.get(pk=batch_pk).shard_complete(result)
+    logger.info('invoice_contacts: created {} invoices, {} errors'.format(
+        len(result['invoices']),
+        len(result['errors']),
+    ))
+    for contact_pk, message in result['errors']:
+        logger.error('invoice_contacts: contact {}: {}'.format(
+            contact_pk, message
+        ))
+    return result
+
+
+@shared_task
+def invoice_print(job_pk):
+    """Create the PDF for an invoice (see ``InvoicePrintJob``)."""
+    job = InvoicePrint().create_pdf_for_job(job_pk)
+    logger.info('invoice_print: job {} is {}'.format(job.pk, job.status))
+    return job.status
+
+
 @shared_task
 def mail_time_summary():
     users = []
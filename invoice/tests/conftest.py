@@ -0,0 +1,18 @@
+# -*- encoding: utf-8 -*-
+import pytest
+
+from django.core.cache import cache
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    """Start each test with an empty cache.
+
+    The cache is shared by all the tests in the process.  Saving a time
+    record only clears the cache when the transaction is committed, which
+    does not happen in a test which is rolled back.
+
+    """
+    cache.clear()
+    yield
+    cache.clear()
@@ -2,9 +2,10 @@
 import pytest
 
 from decimal import Decimal
+from django.db import transaction
 
 from finance.tests.factories import VatSettingsFactory
-from invoice.models import Invoice, InvoiceLine
+from invoice.models import Invoice, InvoiceLine, InvoiceSequence
 from invoice.service import InvoicePrint
 from invoice.tests.factories import (
     InvoiceFactory,
@@ -91,6 +92,30 @@ def test_get_next_line_number_two_invoices():
     assert 2 == invoice_2.get_next_line_number()
 
 
+@pytest.mark.django_db
+def test_get_next_line_number_zero():
+    invoice = InvoiceFactory()
+    InvoiceLineFactory(invoice=invoice, line_number=0)
+    InvoiceLineFactory(invoice=invoice, line_number=1)
+    assert 2 == invoice.get_next_line_number()
+
+
+@pytest.mark.django_db
+def test_reserve_line_numbers():
+    invoice = InvoiceFactory()
+    InvoiceLineFactory(invoice=invoice, line_number=1)
+    InvoiceLineFactory(invoice=invoice, line_number=3)
+    with transaction.atomic():
+        assert [4, 5, 6] == list(invoice.reserve_line_numbers(3))
+
+
+@pytest.mark.django_db
+def test_reserve_line_numbers_first():
+    invoice = InvoiceFactory()
+    with transaction.atomic():
+        assert [1, 2] == list(invoice.reserve_line_numbers(2))
+
+
 @pytest.mark.django_db
 def test_has_lines():
     """does the invoice have any lines"""
@@ -123,6 +148,152 @@ def test_next_number_2():
     assert 1 == Invoice.objects.next_number()
 
 
+@pytest.mark.django_db
+def test_next_number_sequence():
+    """The sequence does not hand out the same number twice."""
+    InvoiceFactory(number=5)
+    assert 6 == Invoice.objects.next_number()
+    InvoiceFactory(number=6)
+    assert 7 == Invoice.objects.next_number()
+    assert 7 == InvoiceSequence.objects.get().last_number
+
+
+@pytest.mark.django_db
+def test_next_number_sequence_deleted():
+    """The number of a deleted invoice is not used again."""
+    InvoiceFactory(number=5)
+    invoice = InvoiceFactory(number=Invoice.objects.next_number())
+    assert 6 == invoice.number
+    invoice.deleted = True
+    invoice.save()
+    assert 7 == Invoice.objects.next_number()
+
+
+@pytest.mark.django_db
+def test_next_number_sequence_forward():
+    """The sequence moves forward if an invoice is saved with a number."""
+    InvoiceFactory(number=5)
+    assert 6 == Invoice.objects.next_number()
+    InvoiceFactory(number=6)
+    InvoiceFactory(number=7)
+    assert 7 == InvoiceSequence.objects.get().last_number
+    assert 8 == Invoice.objects.next_number()
+
+
+@pytest.mark.django_db
+def test_number_gaps():
+    InvoiceFactory(number=1)
+    InvoiceFactory(number=2)
+    InvoiceFactory(number=5)
+    InvoiceFactory(number=6, deleted=True)
+    InvoiceFactory(number=8)
+    assert [(3, 4), (6, 7)] == Invoice.objects.number_gaps()
+
+
+@pytest.mark.django_db
+def test_number_gaps_none():
+    InvoiceFactory(number=1)
+    InvoiceFactory(number=2)
+    assert [] == Invoice.objects.number_gaps()
+
+
+@pytest.mark.django_db
+def test_reserve_numbers():
+    InvoiceFactory(number=2)
+    assert [3, 4, 5] == list(InvoiceSequence.objects.reserve(3))
+    assert 6 == Invoice.objects.next_number()
+
+
+@pytest.mark.django_db
+def test_totals():
+    """The totals are updated when a line is saved."""
+    VatSettingsFactory()
+    invoice = InvoiceFactory()
+    line = InvoiceLineFactory(
+        invoice=invoice,
+        quantity=Decimal('2'),
+        price=Decimal('10.00'),
+    )
+    invoice.refresh_from_db()
+    assert 1 == invoice.line_count
+    assert Decimal('20.00') == invoice.net
+    assert Decimal('4.00') == invoice.vat
+    assert Decimal('24.00') == invoice.gross
+    line.quantity = Decimal('3')
+    line.save()
+    invoice.refresh_from_db()
+    assert Decimal('30.00') == invoice.net
+    assert Decimal('36.00') == invoice.gross
+
+
+@pytest.mark.django_db
+def test_totals_delete_line():
+    VatSettingsFactory()
+    invoice = InvoiceFactory()
+    InvoiceLineFactory(invoice=invoice, price=Decimal('10.00'))
+    line = InvoiceLineFactory(invoice=invoice, price=Decimal('5.00'))
+    line.delete()
+    invoice.refresh_from_db()
+    assert 1 == invoice.line_count
+    assert Decimal('10.00') == invoice.net
+
+
+@pytest.mark.django_db
+def test_totals_save_stale_invoice():
+    """Saving an old copy of the invoice must not overwrite the totals."""
+    VatSettingsFactory()
+    invoice = InvoiceFactory()
+    stale = Invoice.objects.get(pk=invoice.pk)
+    InvoiceLineFactory(invoice=invoice, price=Decimal('10.00'))
+    stale.save()
+    invoice.refresh_from_db()
+    assert 1 == invoice.line_count
+    assert Decimal('10.00') == invoice.net
+
+
+@pytest.mark.django_db
+def test_with_totals():
+    VatSettingsFactory()
+    invoice = InvoiceFactory()
+    InvoiceLineFactory(invoice=invoice, price=Decimal('10.00'))
+    InvoiceLineFactory(
+        invoice=invoice,
+        price=Decimal('3.00'),
+        quantity=Decimal('-5'),
+    )
+    InvoiceFactory()
+    qs = Invoice.objects.with_totals().order_by('pk')
+    assert [
+        (Decimal('-5.00'), Decimal('-1.00'), Decimal('-6.00'), 2, True),
+        (Decimal(), Decimal(), Decimal(), 0, False),
+    ] == [
+        (
+            x.total_net,
+            x.total_vat,
+            x.total_gross,
+            x.total_line_count,
+            x.total_is_credit,
+        )
+        for x in qs
+    ]
+
+
+@pytest.mark.django_db
+def test_with_totals_line_totals():
+    """'line_totals' uses the annotations (so doesn't need a query)."""
+    VatSettingsFactory()
+    invoice = InvoiceFactory()
+    InvoiceLineFactory(invoice=invoice, price=Decimal('10.00'))
+    invoice = Invoice.objects.with_totals().get(pk=invoice.pk)
+    expect = {
+        'gross': Decimal('12.00'),
+        'line_count': 1,
+        'net': Decimal('10.00'),
+        'vat': Decimal('2.00'),
+    }
+    assert expect == invoice.line_totals()
+
+
 @pytest.mark.django_db
 def test_user_can_edit():
     line = InvoiceLineFactory()
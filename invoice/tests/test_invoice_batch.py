@@ -92,3 +92,48 @@ def test_create_invoices_do_not_bill_twice():
     assert 1 == Invoice.objects.filter(contact=contact).count()
     InvoiceCreateBatch().create(user, date(2012, 9, 30))
     assert 1 == Invoice.objects.filter(contact=contact).count()
+
+
+@pytest.mark.django_db
+def test_create_invoices_summary():
+    """Contacts without time are skipped, errors do not stop the batch."""
+    InvoiceSettingsFactory()
+    VatSettingsFactory()
+    # no hourly rate for this contact
+    c1 = ContactFactory()
+    TimeRecordFactory(
+        ticket=TicketFactory(contact=c1),
+        date_started=date(2012, 7, 1),
+    )
+    c2 = ContactFactory()
+    InvoiceContactFactory(contact=c2)
+    TimeRecordFactory(
+        ticket=TicketFactory(contact=c2),
+        date_started=date(2012, 7, 1),
+    )
+    # no time records to invoice
+    InvoiceContactFactory(contact=ContactFactory())
+    result = InvoiceCreateBatch().create(UserFactory(), date(2012, 9, 30))
+    invoice = Invoice.objects.get(contact=c2)
+    assert [invoice.pk] == result['invoices']
+    assert [c1.pk] == [contact_pk for contact_pk, message in result['errors']]
+    assert 1 == Invoice.objects.count()
+
+
+@pytest.mark.django_db
+def test_shards():
+    contacts = []
+    for count in range(5):
+        contact = ContactFactory()
+        TimeRecordFactory(
+            ticket=TicketFactory(contact=contact),
+            date_started=date(2012, 7, 1),
+        )
+        contacts.append(contact.pk)
+    # no time records to invoice
+    ContactFactory()
+    shards = InvoiceCreateBatch().shards(date(2012, 9, 30), 2)
+    assert [
+        [contacts[0], contacts[2], contacts[4]],
+        [contacts[1], contacts[3]],
+    ] == shards
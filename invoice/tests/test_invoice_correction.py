@@ -3,9 +3,10 @@ import pytest
 
 from datetime import date
 from dateutil.relativedelta import relativedelta
+from decimal import Decimal
 
 from finance.tests.factories import VatSettingsFactory
-from invoice.models import InvoiceError
+from invoice.models import InvoiceError, TimeRecord
 from invoice.service import (
     InvoiceCreate,
     InvoicePrint,
@@ -48,6 +49,54 @@ def test_set_is_draft():
     assert invoice.is_draft is True
 
 
+@pytest.mark.django_db
+def test_set_is_draft_print_unchanged():
+    """Print an invoice again (no changes), so re-use the previous PDF."""
+    InvoiceSettingsFactory()
+    VatSettingsFactory()
+    tr = TimeRecordFactory()
+    InvoiceContactFactory(contact=tr.ticket.contact)
+    invoice = InvoiceCreate().create(
+        tr.user, tr.ticket.contact, date.today()
+    )
+    InvoicePrint().create_pdf(invoice, None)
+    pdf_name = invoice.pdf.name
+    fingerprint = invoice.pdf_fingerprint
+    assert 64 == len(fingerprint)
+    invoice.set_to_draft()
+    assert pdf_name == invoice.previous_pdf.name
+    InvoicePrint().create_pdf(invoice, None)
+    invoice.refresh_from_db()
+    assert invoice.is_draft is False
+    assert pdf_name == invoice.pdf.name
+    assert fingerprint == invoice.pdf_fingerprint
+    assert '' == invoice.previous_pdf.name
+
+
+@pytest.mark.django_db
+def test_set_is_draft_print_changed():
+    """Print an invoice again (with a new line), so create a new PDF."""
+    InvoiceSettingsFactory()
+    VatSettingsFactory()
+    tr = TimeRecordFactory()
+    InvoiceContactFactory(contact=tr.ticket.contact)
+    invoice = InvoiceCreate().create(
+        tr.user, tr.ticket.contact, date.today()
+    )
+    InvoicePrint().create_pdf(invoice, None)
+    pdf_name = invoice.pdf.name
+    fingerprint = invoice.pdf_fingerprint
+    invoice.set_to_draft()
+    InvoiceLineFactory(invoice=invoice)
+    invoice.refresh_from_db()
+    InvoicePrint().create_pdf(invoice, None)
+    invoice.refresh_from_db()
+    assert invoice.is_draft is False
+    assert pdf_name != invoice.pdf.name
+    assert fingerprint != invoice.pdf_fingerprint
+    assert '' == invoice.previous_pdf.name
+
+
 @pytest.mark.django_db
 def test_set_is_draft_too_late():
     """invoice can only be set back to draft on the day it is created."""
@@ -120,6 +169,31 @@ def test_remove_time_lines_not_extra():
     assert [extra_line.pk] == [i.pk for i in invoice.invoiceline_set.all()]
 
 
+@pytest.mark.django_db
+def test_remove_time_lines_unlink():
+    """The time records can be invoiced again."""
+    InvoiceSettingsFactory()
+    VatSettingsFactory()
+    tr = TimeRecordFactory()
+    InvoiceContactFactory(contact=tr.ticket.contact)
+    TimeRecordFactory(ticket=tr.ticket)
+    TimeRecordFactory(ticket=tr.ticket)
+    invoice = InvoiceCreate().create(
+        tr.user, tr.ticket.contact, date.today()
+    )
+    extra_line = InvoiceLineFactory(invoice=invoice, price=Decimal('10'))
+    assert 4 == invoice.line_count
+    invoice.remove_time_lines()
+    assert 0 == TimeRecord.objects.filter(invoice_line__isnull=False).count()
+    assert 3 == TimeRecord.objects.to_invoice(
+        tr.ticket.contact, date.today()
+    ).count()
+    invoice.refresh_from_db()
+    assert 1 == invoice.line_count
+    assert Decimal('10.00') == invoice.net
+    assert [extra_line.pk] == [i.pk for i in invoice.invoiceline_set.all()]
+
+
 @pytest.mark.django_db
 def test_refresh():
     """Create a draft invoice, and then add more time records to it."""
@@ -0,0 +1,69 @@
+# -*- encoding: utf-8 -*-
+import pytest
+import threading
+
+from datetime import date
+from django.db import connection
+
+from contact.tests.factories import ContactFactory
+from crm.tests.factories import TicketFactory
+from finance.tests.factories import VatSettingsFactory
+from invoice.models import Invoice, InvoiceLine, TimeRecord
+from invoice.service import InvoiceCreate
+from invoice.tests.factories import (
+    InvoiceContactFactory,
+    InvoiceSettingsFactory,
+    TimeRecordFactory,
+)
+from login.tests.factories import UserFactory
+
+
+WORKERS = 4
+
+
+@pytest.mark.django_db(transaction=True)
+def test_create_parallel():
+    """Invoice the same contact from several workers at the same time.
+
+    Each time record must be on exactly one invoice line and no worker
+    should fail.
+
+    Run the tests using PostgreSQL (SQLite cannot lock rows, so the test is
+    skipped).
+
+    """
+    # check inside the test (the database is not available at collection)
+    if not connection.features.has_select_for_update_skip_locked:
+        pytest.skip('the database does not support SKIP LOCKED')
+    InvoiceSettingsFactory()
+    VatSettingsFactory()
+    contact = ContactFactory()
+    InvoiceContactFactory(contact=contact)
+    for count in range(3):
+        ticket = TicketFactory(contact=contact)
+        for day in range(1, 21):
+            TimeRecordFactory(ticket=ticket, date_started=date(2017, 1, day))
+    user = UserFactory()
+    barrier = threading.Barrier(WORKERS)
+    errors = []
+
+    def worker():
+        try:
+            barrier.wait()
+            InvoiceCreate().create(user, contact, date(2017, 1, 31))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker) for i in range(WORKERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [] == errors
+    assert 0 == TimeRecord.objects.filter(invoice_line__isnull=True).count()
+    assert 60 == InvoiceLine.objects.filter(invoice__contact=contact).count()
+    numbers = sorted(x.number for x in Invoice.objects.all())
+    assert list(range(1, len(numbers) + 1)) == numbers
+    assert 60 == sum(x.line_count for x in Invoice.objects.all())
@@ -1,14 +1,26 @@
 # -*- encoding: utf-8 -*-
+import io
+import os
+import PIL.Image
+import tempfile
+
 from datetime import date
+from reportlab import platypus
+from unittest import mock
 
+from django.conf import settings
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from contact.tests.factories import ContactFactory
 from crm.tests.factories import TicketFactory
 from finance.tests.factories import VatSettingsFactory
-from invoice.models import InvoiceError
+from invoice.models import Invoice, InvoiceError
 from invoice.service import (
     InvoiceCreate,
+    InvoiceLetterhead,
+    InvoiceLinesChunk,
     InvoicePrint,
 )
 from invoice.tests.factories import (
@@ -37,6 +49,185 @@ class TestInvoicePrint(TestCase):
         )
         InvoicePrint().create_pdf(invoice, None)
 
+    def test_invoice_create_pdf_chunks(self):
+        """A large invoice is drawn in chunks (over several pages)."""
+        InvoiceSettingsFactory()
+        VatSettingsFactory()
+        contact = ContactFactory()
+        InvoiceContactFactory(contact=contact)
+        ticket = TicketFactory(contact=contact)
+        for i in range(InvoicePrint.TABLE_CHUNK_ROWS * 3):
+            TimeRecordFactory(ticket=ticket, date_started=date(2013, 12, 1))
+        invoice = InvoiceCreate().create(
+            UserFactory(),
+            contact,
+            date(2013, 12, 31)
+        )
+        invoice_print = InvoicePrint()
+        invoice_lines = invoice_print._invoice_lines(invoice)
+        tables = invoice_print._table_lines(invoice_lines)
+        self.assertEqual(4, len(tables))
+        self.assertNotIsInstance(tables[0], InvoiceLinesChunk)
+        for table in tables[1:]:
+            self.assertIsInstance(table, InvoiceLinesChunk)
+        invoice_print.create_pdf(invoice, None)
+
+    def test_invoice_create_pdf_chunk_count(self):
+        """The number of chunks grows in line with the number of lines.
+
+        So the time to draw the lines also grows in line with the number of
+        lines (see ``benchmark_invoice_pdf`` to time them).
+
+        """
+        invoice_print = InvoicePrint()
+        chunk_rows = InvoicePrint.TABLE_CHUNK_ROWS
+        for count in (1, chunk_rows, chunk_rows * 10 + 1, chunk_rows * 100):
+            lines = [
+                ['{}'.format(i), 'Support', '1.00', '20', '0.20', '1.20']
+                for i in range(count)
+            ]
+            tables = invoice_print._table_lines_data(lines)
+            self.assertEqual(-(-count // chunk_rows), len(tables))
+            for table in tables[1:]:
+                self.assertLessEqual(table.end - table.start, chunk_rows)
+            self.assertEqual(
+                count,
+                min(count, chunk_rows) + sum(
+                    table.end - table.start for table in tables[1:]
+                ),
+            )
+
+    def test_invoice_create_pdf_file(self):
+        """The PDF is written to a temporary file and saved to the store."""
+        InvoiceSettingsFactory()
+        VatSettingsFactory()
+        invoice = InvoiceFactory()
+        InvoiceLineFactory(invoice=invoice)
+        InvoicePrint().create_pdf(invoice, None)
+        invoice.refresh_from_db()
+        self.assertTrue(invoice.pdf.name.endswith('.pdf'))
+        with invoice.pdf.open('rb') as f:
+            self.assertEqual(b'%PDF', f.read(4))
+        self.assertLess(0, invoice.pdf.size)
+        # the temporary file is moved (and can be read by the web server)
+        folder = os.path.dirname(invoice.pdf.path)
+        self.assertEqual(
+            [], [x for x in os.listdir(folder) if x.endswith('.upload')]
+        )
+        self.assertEqual(
+            settings.FILE_UPLOAD_PERMISSIONS or InvoicePrint.PDF_PERMISSIONS,
+            os.stat(invoice.pdf.path).st_mode & 0o777,
+        )
+
+    def test_invoice_create_pdf_query_count(self):
+        """The number of queries does not depend on the number of lines."""
+        InvoiceSettingsFactory()
+        VatSettingsFactory()
+        counts = []
+        for count in (2, 8):
+            contact = ContactFactory()
+            InvoiceContactFactory(contact=contact)
+            for i in range(count):
+                TimeRecordFactory(
+                    ticket=TicketFactory(contact=contact),
+                    date_started=date(2013, 12, 1),
+                )
+            invoice = InvoiceCreate().create(
+                UserFactory(),
+                contact,
+                date(2013, 12, 31)
+            )
+            InvoiceLineFactory(invoice=invoice)
+            with CaptureQueriesContext(connection) as queries:
+                InvoicePrint().create_pdf(invoice, None)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_invoice_letterhead(self):
+        """The letterhead is reused until the settings change."""
+        invoice_settings = InvoiceSettingsFactory(phone_number='01234')
+        vat_settings = VatSettingsFactory()
+        report = InvoicePrint()
+        letterhead = InvoiceLetterhead.letterhead(
+            report, invoice_settings, vat_settings, None
+        )
+        self.assertIs(letterhead, InvoiceLetterhead.letterhead(
+            report, invoice_settings, vat_settings, None
+        ))
+        invoice_settings.phone_number = '05678'
+        self.assertIsNot(letterhead, InvoiceLetterhead.letterhead(
+            report, invoice_settings, vat_settings, None
+        ))
+
+    def test_invoice_letterhead_image(self):
+        """Each document gets new flowables, but the image is decoded once."""
+        invoice_settings = InvoiceSettingsFactory()
+        vat_settings = VatSettingsFactory()
+        report = InvoicePrint()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            header_image = os.path.join(temp_dir, 'header.png')
+            PIL.Image.new('RGB', (40, 20), 'red').save(header_image)
+            with mock.patch(
+                    'invoice.service.os.path.getmtime',
+                    wraps=os.path.getmtime) as getmtime:
+                letterheads = [
+                    InvoiceLetterhead.letterhead(
+                        report, invoice_settings, vat_settings, header_image
+                    )
+                    for i in range(3)
+                ]
+            # the image is only checked (for changes) when it is loaded
+            self.assertEqual(1, getmtime.call_count)
+            letterhead = letterheads[0]
+            for x in letterheads:
+                self.assertIs(letterhead, x)
+            images = []
+            for i in range(2):
+                our_details = letterhead.our_details()
+                platypus.SimpleDocTemplate(io.BytesIO()).build(
+                    our_details + letterhead.footer()
+                )
+                images.append(our_details[0])
+        self.assertIsInstance(images[0], platypus.Image)
+        self.assertIsNot(images[0], images[1])
+        # the image data is decoded once and shared by the documents
+        self.assertIs(images[0]._img, images[1]._img)
+        self.assertIsNotNone(images[0]._img._data)
+
+    def test_invoice_create_pdfs(self):
+        InvoiceSettingsFactory()
+        VatSettingsFactory()
+        invoice = InvoiceFactory()
+        InvoiceLineFactory(invoice=invoice)
+        no_lines = InvoiceFactory()
+        invoice_print = InvoicePrint()
+        self.assertEqual(
+            [invoice.pk, no_lines.pk],
+            [obj.pk for obj in invoice_print.drafts()],
+        )
+        result = invoice_print.create_pdfs(
+            [invoice.pk, no_lines.pk],
+            processes=1,
+        )
+        self.assertEqual([invoice.pk, no_lines.pk], [x['pk'] for x in result])
+        self.assertIsNone(result[0]['error'])
+        self.assertIn('has no lines', result[1]['error'])
+        self.assertEqual([no_lines.pk], [x.pk for x in invoice_print.drafts()])
+        # already has a PDF
+        result = invoice_print.create_pdfs([invoice.pk], processes=1)
+        self.assertIsNone(result[0]['file_name'])
+
+    def test_invoice_create_pdfs_in_transaction(self):
+        """The pool would close the connection for the test transaction."""
+        invoice = InvoiceFactory()
+        InvoiceLineFactory(invoice=invoice)
+        no_lines = InvoiceFactory()
+        with self.assertRaises(InvoiceError) as e:
+            InvoicePrint().create_pdfs([invoice.pk, no_lines.pk], processes=2)
+        self.assertIn('inside a transaction', str(e.exception))
+        self.assertTrue(connection.in_atomic_block)
+        self.assertEqual(2, Invoice.objects.count())
+
     def test_invoice_create_pdf_no_lines(self):
         """Cannot create a PDF if the invoice has no lines"""
         invoice = InvoiceFactory()
@@ -3,6 +3,8 @@ import pytest
 
 from datetime import date
 from decimal import Decimal
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from contact.tests.factories import ContactFactory
 from crm.tests.factories import TicketFactory
@@ -12,6 +14,7 @@ from invoice.service import (
     InvoiceError,
     InvoicePrint,
 )
+from invoice.models import Invoice, TimeRecord
 from invoice.tests.factories import (
     InvoiceContactFactory,
     InvoiceSettingsFactory,
@@ -38,6 +41,19 @@ def test_invoice_with_time_records():
     assert Decimal('40.00') == invoice.net
 
 
+@pytest.mark.django_db
+def test_invoice_with_time_records_first_number():
+    """The first invoice is number 1 (not the temporary number)."""
+    InvoiceSettingsFactory()
+    VatSettingsFactory()
+    contact = ContactFactory()
+    InvoiceContactFactory(contact=contact)
+    tr = TimeRecordFactory(ticket=TicketFactory(contact=contact))
+    invoice = InvoiceCreate().create(tr.user, contact, date.today())
+    invoice.refresh_from_db()
+    assert 1 == invoice.number
+
+
 @pytest.mark.django_db
 def test_invoice_with_time_records_no_end_time():
     """One of the time records has no end time, so cannot be invoiced."""
@@ -54,3 +70,52 @@ def test_invoice_with_time_records_no_end_time():
     message = str(ex.value)
     assert 'does not have a' in message
     assert 'end time' in message
+
+
+@pytest.mark.django_db
+def test_invoice_with_time_records_lines():
+    """Each time record is linked to its own invoice line."""
+    InvoiceSettingsFactory()
+    VatSettingsFactory()
+    contact = ContactFactory()
+    InvoiceContactFactory(contact=contact)
+    ticket = TicketFactory(contact=contact)
+    for day in range(1, 6):
+        TimeRecordFactory(ticket=ticket, date_started=date(2017, 1, day))
+    invoice = InvoiceCreate().create(
+        ticket.user, contact, date(2017, 1, 31)
+    )
+    assert 5 == invoice.line_count
+    assert Decimal('100.00') == invoice.net
+    qs = TimeRecord.objects.filter(
+        ticket=ticket
+    ).order_by(
+        'date_started'
+    )
+    assert [
+        (date(2017, 1, 1), 1),
+        (date(2017, 1, 2), 2),
+        (date(2017, 1, 3), 3),
+        (date(2017, 1, 4), 4),
+        (date(2017, 1, 5), 5),
+    ] == [(x.date_started, x.invoice_line.line_number) for x in qs]
+
+
+@pytest.mark.django_db
+def test_invoice_with_time_records_query_count():
+    """The number of queries does not depend on the number of records."""
+    InvoiceSettingsFactory()
+    VatSettingsFactory()
+    # create the invoice sequence (so the first invoice doesn't create it)
+    Invoice.objects.next_number()
+    result = []
+    for count in (2, 6):
+        contact = ContactFactory()
+        InvoiceContactFactory(contact=contact)
+        ticket = TicketFactory(contact=contact)
+        for day in range(count):
+            TimeRecordFactory(ticket=ticket, date_started=date(2017, 1, 1))
+        with CaptureQueriesContext(connection) as queries:
+            InvoiceCreate().create(ticket.user, contact, date(2017, 1, 31))
+        result.append(len(queries))
+    assert result[0] == result[1]
@@ -1,7 +1,60 @@
 # -*- encoding: utf-8 -*-
 import pytest
 
-from invoice.management.commands import init_app_invoice, report_hours_per_week
+from decimal import Decimal
+
+from django.core.files.base import ContentFile
+
+from base.model_utils import private_file_store
+from finance.tests.factories import VatSettingsFactory
+from invoice.management.commands import (
+    benchmark_invoice_pdf,
+    create_invoice_pdfs,
+    init_app_invoice,
+    rebuild_time_record_day,
+    report_hours_per_week,
+    report_invoice_number_gaps,
+    sweep_invoice_pdfs,
+    update_invoice_totals,
+)
+from invoice.models import Invoice, TimeRecordDay
+from invoice.service import InvoicePrint
+from invoice.tests.factories import (
+    InvoiceFactory,
+    InvoiceLineFactory,
+    InvoiceSettingsFactory,
+    TimeRecordFactory,
+)
+
+
+@pytest.mark.django_db
+def test_benchmark_invoice_pdf(capsys):
+    """ Test the management command """
+    InvoiceSettingsFactory()
+    VatSettingsFactory()
+    invoice = InvoiceFactory()
+    InvoiceLineFactory(invoice=invoice)
+    command = benchmark_invoice_pdf.Command()
+    command.handle(lines=[5])
+    out, err = capsys.readouterr()
+    assert 'Chunks: 5 lines in ' in out
+    # the invoices used for the benchmark are rolled back
+    assert [invoice.pk] == [x.pk for x in Invoice.objects.all()]
+
+
+@pytest.mark.django_db
+def test_create_invoice_pdfs():
+    """ Test the management command """
+    InvoiceSettingsFactory()
+    VatSettingsFactory()
+    invoice = InvoiceFactory()
+    InvoiceLineFactory(invoice=invoice)
+    # no lines, so cannot create the PDF
+    InvoiceFactory()
+    command = create_invoice_pdfs.Command()
+    command.handle(processes=1)
+    invoice.refresh_from_db()
+    assert invoice.is_draft is False
 
 
 @pytest.mark.django_db
@@ -11,8 +64,73 @@ def test_init_app():
     command.handle()
 
 
+@pytest.mark.django_db
+def test_rebuild_time_record_day():
+    """ Test the management command """
+    TimeRecordFactory()
+    TimeRecordDay.objects.all().delete()
+    command = rebuild_time_record_day.Command()
+    command.handle(verify=True)
+    assert 0 == TimeRecordDay.objects.count()
+    command.handle(verify=False)
+    assert 1 == TimeRecordDay.objects.count()
+    assert [] == TimeRecordDay.objects.verify()
+
+
 @pytest.mark.django_db
 def test_report_hours_per_week():
     """ Test the management command """
     command = report_hours_per_week.Command()
     command.handle()
+
+
+@pytest.mark.django_db
+def test_report_invoice_number_gaps():
+    """ Test the management command """
+    InvoiceFactory(number=1)
+    InvoiceFactory(number=3)
+    command = report_invoice_number_gaps.Command()
+    command.handle()
+
+
+@pytest.mark.django_db
+def test_update_invoice_totals():
+    """ Test the management command """
+    VatSettingsFactory()
+    invoice = InvoiceFactory()
+    InvoiceLineFactory(invoice=invoice, price=Decimal('10.00'))
+    Invoice.objects.filter(pk=invoice.pk).update(net=Decimal(), line_count=0)
+    command = update_invoice_totals.Command()
+    command.handle(verify=True)
+    invoice.refresh_from_db()
+    assert 0 == invoice.line_count
+    command.handle(verify=False)
+    invoice.refresh_from_db()
+    assert 1 == invoice.line_count
+    assert Decimal('10.00') == invoice.net
+
+
+@pytest.mark.django_db
+def test_sweep_invoice_pdfs(monkeypatch, tmpdir):
+    """ Test the management command """
+    # sweep a temporary folder (not the PDFs in the real store)
+    for name in ('_location', 'base_location', 'location'):
+        monkeypatch.setattr(private_file_store, name, str(tmpdir))
+    InvoiceSettingsFactory()
+    VatSettingsFactory()
+    invoice = InvoiceFactory()
+    InvoiceLineFactory(invoice=invoice)
+    InvoicePrint().create_pdf(invoice, None)
+    orphan = private_file_store.save(
+        'invoice/2017/01/31/000001.pdf', ContentFile(b'%PDF')
+    )
+    command = sweep_invoice_pdfs.Command()
+    command.handle(dry_run=True, hours=0)
+    assert private_file_store.exists(orphan) is True
+    # the orphan is newer than 24 hours
+    command.handle()
+    assert private_file_store.exists(orphan) is True
+    command.handle(hours=0)
+    assert private_file_store.exists(orphan) is False
+    assert private_file_store.exists(invoice.pdf.name) is True
+    assert tmpdir.join(invoice.pdf.name).check(file=1)
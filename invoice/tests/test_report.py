@@ -2,21 +2,33 @@
 """
 Test report.
 """
+import csv
+import io
 import pytest
 import pytz
 
 from datetime import date, datetime, time
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
+from django.core.cache import cache
+from django.db import connection, IntegrityError, transaction
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from contact.tests.factories import ContactFactory
 from crm.tests.factories import TicketFactory
-from invoice.models import TimeRecord
+from invoice.models import (
+    time_summary_cache_key,
+    TimeRecord,
+    TimeSummaryMonth,
+)
 from invoice.report import (
+    ReportInvoiceTimeAnalysis,
+    ReportInvoiceTimeAnalysisCSV,
     time_summary,
     time_summary_by_user,
     time_summary_by_user_for_chartist,
+    time_summary_for_dash,
 )
 from invoice.tests.factories import (
     InvoiceFactory,
@@ -253,6 +265,54 @@ def test_report_time_by_ticket():
     } == data
 
 
+@pytest.mark.django_db
+def test_report_time_by_ticket_fixed_price():
+    user = UserFactory(username='green')
+    d = timezone.now().date()
+    t1 = TicketFactory(pk=1, contact=ContactFactory(), fixed_price=True)
+    t2 = TicketFactory(pk=2, contact=ContactFactory())
+    TimeRecordFactory(
+        ticket=t1,
+        date_started=d,
+        start_time=time(11, 0),
+        end_time=time(11, 30),
+        user=user,
+    )
+    TimeRecordFactory(
+        billable=False,
+        ticket=t2,
+        date_started=d,
+        start_time=time(12, 0),
+        end_time=time(12, 15),
+        user=user,
+    )
+    TimeRecordFactory(
+        billable=True,
+        ticket=t2,
+        date_started=d,
+        start_time=time(10, 0),
+        end_time=time(10, 5),
+        user=user,
+    )
+    # not complete (so not included)
+    TimeRecordFactory(
+        ticket=t2,
+        date_started=d,
+        start_time=time(13, 0),
+        end_time=None,
+        user=user,
+    )
+    with CaptureQueriesContext(connection) as queries:
+        data = TimeRecord.objects.report_time_by_ticket(user, d)
+    assert 1 == len(queries)
+    # the most recent ticket first
+    assert [2, 1] == list(data.keys())
+    assert {
+        1: {'Chargeable': 0, 'Fixed-Price': 30.0, 'Non-Chargeable': 0},
+        2: {'Chargeable': 5.0, 'Fixed-Price': 0, 'Non-Chargeable': 15.0},
+    } == data
+
+
 @pytest.mark.django_db
 def test_report_time_by_user_by_week():
     user = UserFactory(username='green')
@@ -344,6 +404,103 @@ def test_report_total_by_user():
     assert invoice.net == net
 
 
+@pytest.mark.django_db
+def test_report_total_by_user_quantity():
+    contact = ContactFactory()
+    invoice = InvoiceFactory(contact=contact)
+    InvoiceLineFactory(invoice=invoice, quantity=Decimal('2'))
+    user = UserFactory(username='u1')
+    ticket = TicketFactory(contact=contact)
+    TimeRecordFactory(
+        ticket=ticket,
+        user=user,
+        date_started=date(2017, 1, 2),
+        start_time=time(10, 0),
+        end_time=time(10, 20),
+        invoice_line=InvoiceLineFactory(invoice=invoice),
+    )
+    TimeRecordFactory(
+        ticket=ticket,
+        user=user,
+        date_started=date(2017, 1, 9),
+        start_time=time(11, 0),
+        end_time=time(11, 40, 30),
+        invoice_line=InvoiceLineFactory(invoice=invoice),
+    )
+    with CaptureQueriesContext(connection) as queries:
+        result = invoice.time_analysis()
+    assert 1 == len(queries)
+    assert ['', 'u1'] == sorted(result.keys())
+    assert Decimal('2') == result[''][0]['quantity']
+    totals = result['u1'][ticket.pk]
+    assert Decimal('3630') / Decimal('3600') == totals['quantity']
+    assert date(2017, 1, 2) == totals['start_date']
+    assert date(2017, 1, 9) == totals['end_date']
+
+
+@pytest.mark.django_db
+def test_report_invoice_time_analysis():
+    contact = ContactFactory()
+    invoice = InvoiceFactory(contact=contact, pdf='invoice.pdf')
+    InvoiceLineFactory(invoice=invoice, quantity=Decimal('2'))
+    user = UserFactory(username='u1')
+    for title in ('Apple', 'Orange'):
+        TimeRecordFactory(
+            ticket=TicketFactory(contact=contact, title=title),
+            user=user,
+            date_started=date(2017, 1, 2),
+            start_time=time(10, 0),
+            end_time=time(10, 30),
+            invoice_line=InvoiceLineFactory(invoice=invoice),
+        )
+    invoice.refresh_from_db()
+    report = ReportInvoiceTimeAnalysis()
+    table = report._table_lines(invoice)
+    descriptions = [
+        row[1].text for row in table._cellvalues[1:]
+        if row[1] and row[1].text
+    ]
+    assert sorted(descriptions) == sorted([
+        '{}, Apple'.format(
+            TimeRecord.objects.get(ticket__title='Apple').ticket.pk
+        ),
+        '{}, Orange'.format(
+            TimeRecord.objects.get(ticket__title='Orange').ticket.pk
+        ),
+    ])
+    response = io.BytesIO()
+    report.report(invoice, user, response)
+    assert response.getvalue().startswith(b'%PDF')
+
+
+@pytest.mark.django_db
+def test_report_invoice_time_analysis_csv_stream():
+    contact = ContactFactory()
+    invoice = InvoiceFactory(contact=contact, pdf='invoice.pdf')
+    InvoiceLineFactory(invoice=invoice, quantity=Decimal('2'))
+    user = UserFactory(username='u1')
+    for title in ('Apple', 'Orange'):
+        TimeRecordFactory(
+            ticket=TicketFactory(contact=contact, title=title),
+            user=user,
+            date_started=date(2017, 1, 2),
+            start_time=time(10, 0),
+            end_time=time(10, 30),
+            invoice_line=InvoiceLineFactory(invoice=invoice),
+        )
+    invoice.refresh_from_db()
+    lines = ReportInvoiceTimeAnalysisCSV().stream(invoice)
+    # the header is returned before the time analysis
+    with CaptureQueriesContext(connection) as queries:
+        header = next(lines)
+    assert 0 == len(queries)
+    assert header.startswith('Invoice Number,Invoice Date,')
+    rows = list(csv.reader(lines))
+    assert ['', 'Apple', 'Orange', 'Total', 'Total'] == sorted(
+        [row[7] for row in rows]
+    )
+
+
 @pytest.mark.django_db
 def test_time_summary():
     user = UserFactory(username='green', first_name='P', last_name='Kimber')
@@ -437,6 +594,135 @@ def test_time_summary():
     } == data
 
 
+@pytest.mark.django_db
+def test_time_summary_query_count():
+    user = UserFactory(username='green')
+    d = timezone.now().date()
+    for day in range(8):
+        for count in range(3):
+            TimeRecordFactory(
+                ticket=TicketFactory(contact=ContactFactory()),
+                date_started=d + relativedelta(days=-day),
+                start_time=time(10 + count, 0),
+                end_time=time(10 + count, 30),
+                user=user,
+            )
+    with CaptureQueriesContext(connection) as queries:
+        data = time_summary(user, days=2)
+    assert 1 == len(queries)
+    assert [
+        d,
+        d + relativedelta(days=-1),
+        d + relativedelta(days=-2),
+    ] == list(data.keys())
+    assert 90 == data[d]['total']
+    assert 3 == len(data[d]['tickets'])
+
+
+@pytest.mark.django_db(transaction=True)
+def test_time_summary_cache():
+    user = UserFactory(username='green')
+    d = timezone.now().date()
+    TimeRecordFactory(
+        date_started=d,
+        start_time=time(10, 0),
+        end_time=time(10, 30),
+        user=user,
+    )
+    time_summary(user)
+    with CaptureQueriesContext(connection) as queries:
+        data = time_summary(user)
+    assert 0 == len(queries)
+    assert 30 == data[d]['total']
+    # saving a time record removes the day from the cache
+    obj = TimeRecordFactory(
+        date_started=d,
+        start_time=time(11, 0),
+        end_time=time(11, 15),
+        user=user,
+    )
+    with CaptureQueriesContext(connection) as queries:
+        data = time_summary(user)
+    assert 1 == len(queries)
+    assert 45 == data[d]['total']
+    # move the time record to another day
+    obj = TimeRecord.objects.get(pk=obj.pk)
+    obj.date_started = d + relativedelta(days=-1)
+    obj.save()
+    data = time_summary(user)
+    assert 30 == data[d]['total']
+    assert 15 == data[d + relativedelta(days=-1)]['total']
+    obj.delete()
+    data = time_summary(user)
+    assert [d] == list(data.keys())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_time_summary_cache_on_commit():
+    """The cache is cleared when the transaction is committed."""
+    user = UserFactory(username='green')
+    d = timezone.now().date()
+    time_summary(user)
+    key = time_summary_cache_key(user.pk, d)
+    assert cache.get(key) is not None
+    with transaction.atomic():
+        TimeRecordFactory(
+            date_started=d,
+            start_time=time(10, 0),
+            end_time=time(10, 30),
+            user=user,
+        )
+        assert cache.get(key) is not None
+    assert cache.get(key) is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_time_summary_for_dash():
+    user = UserFactory(username='green')
+    contact = ContactFactory(user=UserFactory(username='orange'))
+    d = timezone.now().date()
+    for billable in (True, True, False):
+        TimeRecordFactory(
+            billable=billable,
+            ticket=TicketFactory(contact=contact),
+            date_started=d,
+            start_time=time(10, 0),
+            end_time=time(10, 30),
+            user=user,
+        )
+    data = time_summary_for_dash()
+    assert [
+        {
+            'billable': False,
+            'minutes': 30,
+            'ticket__contact__user__username': 'orange',
+            'user': user.pk,
+            'user__username': 'green',
+        },
+        {
+            'billable': True,
+            'minutes': 60,
+            'ticket__contact__user__username': 'orange',
+            'user': user.pk,
+            'user__username': 'green',
+        },
+    ] == sorted(data, key=lambda row: row['billable'])
+    with CaptureQueriesContext(connection) as queries:
+        time_summary_for_dash()
+    assert 0 == len(queries)
+    # saving a time record removes the data from the cache
+    TimeRecordFactory(
+        billable=False,
+        ticket=TicketFactory(contact=contact),
+        date_started=d,
+        start_time=time(11, 0),
+        end_time=time(11, 15),
+        user=user,
+    )
+    data = time_summary_for_dash()
+    assert 45 == sum(row['minutes'] for row in data if not row['billable'])
+
+
 @pytest.mark.django_db
 def test_time_summary_by_user():
     user = UserFactory(username='green', first_name='P', last_name='Kimber')
@@ -662,6 +948,60 @@ def test_time_summary_by_user():
     } == data
 
 
+@pytest.mark.django_db
+def test_time_summary_by_user_snapshot():
+    user = UserFactory(username='green')
+    contact = ContactFactory(user=user)
+    TimeRecordFactory(
+        billable=True,
+        ticket=TicketFactory(contact=contact),
+        date_started=date(2016, 12, 1),
+        start_time=time(11, 0),
+        end_time=time(11, 15),
+        user=user,
+    )
+    data = time_summary_by_user(date(2017, 3, 17))
+    assert 15 == data['green']['2016-12']['charge_minutes']
+    # december is closed, so the snapshot is not updated
+    assert 1 == TimeSummaryMonth.objects.filter(user__isnull=False).count()
+    # the other closed months have no time, so they are stored as markers
+    assert 22 == TimeSummaryMonth.objects.filter(user__isnull=True).count()
+    for d in (date(2016, 12, 2), date(2017, 2, 28)):
+        TimeRecordFactory(
+            billable=True,
+            ticket=TicketFactory(contact=contact),
+            date_started=d,
+            start_time=time(11, 0),
+            end_time=time(11, 30),
+            user=user,
+        )
+    with CaptureQueriesContext(connection) as queries:
+        data = time_summary_by_user(date(2017, 3, 17))
+    # stored months, snapshots and the previous month (no missing months)
+    assert 3 == len(queries)
+    assert 15 == data['green']['2016-12']['charge_minutes']
+    assert 30 == data['green']['2017-02']['charge_minutes']
+
+
+@pytest.mark.django_db
+def test_time_summary_month_marker_unique():
+    TimeSummaryMonth.objects.create(
+        charge_minutes=0,
+        fixed_minutes=0,
+        month=date(2016, 12, 1),
+        non_minutes=0,
+    )
+    with pytest.raises(IntegrityError):
+        with transaction.atomic():
+            TimeSummaryMonth.objects.create(
+                charge_minutes=0,
+                fixed_minutes=0,
+                month=date(2016, 12, 1),
+                non_minutes=0,
+            )
+    assert 1 == TimeSummaryMonth.objects.count()
+
+
 @pytest.mark.django_db
 def test_time_summary_by_user_for_chartist():
     """Convert the data extracted from a CSV file to Chartist data"""
@@ -1,7 +1,17 @@
 # -*- encoding: utf-8 -*-
+import pytest
+
 from decimal import Decimal
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
-from invoice.service import format_minutes
+from crm.tests.factories import TicketFactory
+from invoice.service import format_minutes, InvoiceTickets
+from invoice.tests.factories import (
+    InvoiceFactory,
+    InvoiceLineFactory,
+    TimeRecordFactory,
+)
 
 
 def test_format_minutes():
@@ -18,3 +28,26 @@ def test_format_minutes_3():
 
 def test_format_minutes_decimal():
     assert '00:15' == format_minutes(Decimal(15.3))
+
+
+@pytest.mark.django_db
+def test_invoice_tickets():
+    invoice = InvoiceFactory()
+    tickets = []
+    for title in ('Apple', 'Orange', 'Pear'):
+        ticket = TicketFactory(title=title)
+        TimeRecordFactory(
+            ticket=ticket,
+            invoice_line=InvoiceLineFactory(invoice=invoice),
+        )
+        tickets.append(ticket)
+    # not on the invoice
+    other = TicketFactory(title='Plum')
+    TimeRecordFactory(ticket=other)
+    lookup = InvoiceTickets(invoice)
+    with CaptureQueriesContext(connection) as queries:
+        titles = [lookup.title(ticket.pk) for ticket in tickets]
+        assert '' == lookup.title(other.pk)
+        assert tickets[0].contact == lookup.get(tickets[0].pk).contact
+    assert 1 == len(queries)
+    assert ['Apple', 'Orange', 'Pear'] == titles
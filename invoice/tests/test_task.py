@@ -3,15 +3,128 @@ import csv
 import pytest
 
 from datetime import date, time
+from django.db import IntegrityError
 
 from contact.tests.factories import ContactFactory
 from crm.tests.factories import TicketFactory
-from invoice.tasks import time_summary_by_user
-from invoice.tests.factories import TimeRecordFactory
+from finance.tests.factories import VatSettingsFactory
+from invoice.models import Invoice, InvoiceBatch, InvoicePrintJob
+from invoice.service import InvoiceCreate, InvoicePrint
+from invoice.tasks import invoice_batch, invoice_print, time_summary_by_user
+from invoice.tests.factories import (
+    InvoiceContactFactory,
+    InvoiceFactory,
+    InvoiceLineFactory,
+    InvoiceSettingsFactory,
+    TimeRecordFactory,
+)
 from login.tests.factories import UserFactory
 from report.models import ReportSchedule
 
 
+@pytest.mark.django_db
+def test_invoice_batch():
+    InvoiceSettingsFactory()
+    VatSettingsFactory()
+    contacts = []
+    for count in range(3):
+        contact = ContactFactory()
+        InvoiceContactFactory(contact=contact)
+        TimeRecordFactory(
+            ticket=TicketFactory(contact=contact),
+            date_started=date(2012, 7, 1),
+        )
+        contacts.append(contact)
+    batch_pk = invoice_batch(UserFactory().pk, '2012-09-30', shard_count=2)
+    for contact in contacts:
+        assert 1 == Invoice.objects.filter(contact=contact).count()
+    # the summary for the run (from both shards)
+    batch = InvoiceBatch.objects.get(pk=batch_pk)
+    assert batch.is_complete is True
+    assert 2 == batch.shards_complete
+    assert 3 == batch.invoice_count
+    assert 0 == batch.error_count
+    assert '' == batch.errors
+
+
+@pytest.mark.django_db
+def test_invoice_batch_error(monkeypatch):
+    """An unexpected error for one contact does not stop the shard."""
+    def create(self, user, contact, iteration_end):
+        if contact.pk == contacts[0].pk:
+            raise IntegrityError('Duplicate key')
+        return original(self, user, contact, iteration_end)
+
+    original = InvoiceCreate.create
+    monkeypatch.setattr(InvoiceCreate, 'create', create)
+    InvoiceSettingsFactory()
+    VatSettingsFactory()
+    contacts = []
+    for count in range(3):
+        contact = ContactFactory()
+        InvoiceContactFactory(contact=contact)
+        TimeRecordFactory(
+            ticket=TicketFactory(contact=contact),
+            date_started=date(2012, 7, 1),
+        )
+        contacts.append(contact)
+    batch_pk = invoice_batch(UserFactory().pk, '2012-09-30', shard_count=1)
+    assert [0, 1, 1] == [
+        Invoice.objects.filter(contact=contact).count()
+        for contact in contacts
+    ]
+    batch = InvoiceBatch.objects.get(pk=batch_pk)
+    assert batch.is_complete is True
+    assert 2 == batch.invoice_count
+    assert 1 == batch.error_count
+    assert 'contact {}: Duplicate key'.format(contacts[0].pk) == batch.errors
+
+
+@pytest.mark.django_db
+def test_invoice_print():
+    InvoiceSettingsFactory()
+    VatSettingsFactory()
+    invoice = InvoiceFactory()
+    InvoiceLineFactory(invoice=invoice)
+    job = InvoicePrintJob.objects.create_print_job(invoice, UserFactory())
+    assert InvoicePrintJob.COMPLETE == invoice_print(job.pk)
+    invoice.refresh_from_db()
+    assert invoice.is_draft is False
+    pdf_name = invoice.pdf.name
+    # retry the task (the PDF is not created again)
+    assert InvoicePrintJob.COMPLETE == invoice_print(job.pk)
+    invoice.refresh_from_db()
+    assert pdf_name == invoice.pdf.name
+
+
+@pytest.mark.django_db
+def test_invoice_print_not_valid():
+    invoice = InvoiceFactory()
+    job = InvoicePrintJob.objects.create_print_job(invoice, UserFactory())
+    assert InvoicePrintJob.FAILED == invoice_print(job.pk)
+    job.refresh_from_db()
+    assert 'has no lines' in job.message
+    invoice.refresh_from_db()
+    assert invoice.is_draft is True
+
+
+@pytest.mark.django_db
+def test_invoice_print_error(monkeypatch):
+    """An unexpected error is saved on the job (it is not left pending)."""
+    def create_pdf(self, invoice, header_image):
+        raise OSError('Disk full')
+
+    monkeypatch.setattr(InvoicePrint, 'create_pdf', create_pdf)
+    invoice = InvoiceFactory()
+    InvoiceLineFactory(invoice=invoice)
+    job = InvoicePrintJob.objects.create_print_job(invoice, UserFactory())
+    assert InvoicePrintJob.FAILED == invoice_print(job.pk)
+    job.refresh_from_db()
+    assert 'Disk full' == job.message
+    invoice.refresh_from_db()
+    assert invoice.is_draft is True
+
+
 @pytest.mark.django_db
 def test_time_summary_by_user():
     user = UserFactory(username='green', first_name='P', last_name='Kimber')
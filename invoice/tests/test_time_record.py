@@ -18,6 +18,36 @@ from login.tests.factories import UserFactory
 from search.tests.helper import check_search_methods
 
 
+@pytest.mark.django_db
+def test_duration_seconds():
+    obj = TimeRecordFactory(
+        date_started=date(2017, 3, 1),
+        start_time=time(11, 0),
+        end_time=time(12, 30, 15),
+    )
+    obj.refresh_from_db()
+    assert 5415 == obj.duration_seconds
+
+
+@pytest.mark.django_db
+def test_duration_seconds_running():
+    obj = TimeRecordFactory(end_time=None)
+    obj.refresh_from_db()
+    assert obj.duration_seconds is None
+
+
+@pytest.mark.django_db
+def test_duration_seconds_stop():
+    obj = TimeRecordFactory(
+        date_started=date(2017, 3, 1),
+        start_time=time(11, 0),
+        end_time=None,
+    )
+    obj.stop(datetime(2017, 3, 1, 11, 45, 0, tzinfo=pytz.utc))
+    obj.refresh_from_db()
+    assert 2700 == obj.duration_seconds
+
+
 @pytest.mark.django_db
 def test_is_today():
     obj = TimeRecordFactory(date_started=timezone.now().date())
@@ -0,0 +1,184 @@
+# -*- encoding: utf-8 -*-
+import pytest
+
+from datetime import date, time
+
+from contact.tests.factories import ContactFactory
+from crm.tests.factories import TicketFactory
+from invoice.models import TimeRecordDay
+from invoice.tests.factories import TimeRecordFactory
+from login.tests.factories import UserFactory
+
+
+def _totals(user, ticket, day):
+    obj = TimeRecordDay.objects.get(user=user, ticket=ticket, date=day)
+    return (obj.billable_minutes, obj.non_billable_minutes)
+
+
+@pytest.mark.django_db
+def test_add():
+    user = UserFactory()
+    ticket = TicketFactory()
+    d = date(2017, 3, 1)
+    TimeRecordFactory(
+        billable=True,
+        date_started=d,
+        start_time=time(10, 0),
+        end_time=time(10, 30),
+        ticket=ticket,
+        user=user,
+    )
+    TimeRecordFactory(
+        billable=False,
+        date_started=d,
+        start_time=time(11, 0),
+        end_time=time(11, 15),
+        ticket=ticket,
+        user=user,
+    )
+    assert (30, 15) == _totals(user, ticket, d)
+
+
+@pytest.mark.django_db
+def test_add_truncate():
+    """The minutes for each time record are truncated (like the reports)."""
+    user = UserFactory()
+    ticket = TicketFactory()
+    d = date(2017, 3, 1)
+    for start_time, end_time in ((time(10, 0), time(10, 0, 40)),
+                                 (time(11, 0), time(11, 1, 50))):
+        TimeRecordFactory(
+            billable=True,
+            date_started=d,
+            start_time=start_time,
+            end_time=end_time,
+            ticket=ticket,
+            user=user,
+        )
+    assert (1, 0) == _totals(user, ticket, d)
+    assert [] == TimeRecordDay.objects.verify()
+
+
+@pytest.mark.django_db
+def test_delete():
+    user = UserFactory()
+    ticket = TicketFactory()
+    d = date(2017, 3, 1)
+    obj = TimeRecordFactory(
+        billable=True,
+        date_started=d,
+        start_time=time(10, 0),
+        end_time=time(10, 30),
+        ticket=ticket,
+        user=user,
+    )
+    obj.delete()
+    assert (0, 0) == _totals(user, ticket, d)
+    assert [] == TimeRecordDay.objects.verify()
+
+
+@pytest.mark.django_db
+def test_report_dash_contact_changed():
+    """The contact is read from the ticket (so it can be changed)."""
+    user = UserFactory(username='green')
+    ticket = TicketFactory(contact=ContactFactory(user=UserFactory(
+        username='orange'
+    )))
+    d = date(2017, 3, 1)
+    TimeRecordFactory(
+        billable=True,
+        date_started=d,
+        start_time=time(10, 0),
+        end_time=time(10, 30),
+        ticket=ticket,
+        user=user,
+    )
+    ticket.contact = ContactFactory(user=UserFactory(username='pear'))
+    ticket.save()
+    assert [
+        {
+            'billable': True,
+            'minutes': 30,
+            'ticket__contact__user__username': 'pear',
+            'user': user.pk,
+            'user__username': 'green',
+        },
+    ] == TimeRecordDay.objects.report_dash(d, d)
+
+
+@pytest.mark.django_db
+def test_running():
+    TimeRecordFactory(end_time=None)
+    assert 0 == TimeRecordDay.objects.count()
+
+
+@pytest.mark.django_db
+def test_save_change_date():
+    user = UserFactory()
+    ticket = TicketFactory()
+    obj = TimeRecordFactory(
+        billable=False,
+        date_started=date(2017, 3, 1),
+        start_time=time(10, 0),
+        end_time=time(10, 30),
+        ticket=ticket,
+        user=user,
+    )
+    obj.billable = True
+    obj.date_started = date(2017, 3, 2)
+    obj.save()
+    assert (0, 0) == _totals(user, ticket, date(2017, 3, 1))
+    assert (30, 0) == _totals(user, ticket, date(2017, 3, 2))
+
+
+@pytest.mark.django_db
+def test_stop():
+    user = UserFactory()
+    ticket = TicketFactory()
+    d = date(2017, 3, 1)
+    obj = TimeRecordFactory(
+        billable=True,
+        date_started=d,
+        start_time=time(10, 0),
+        end_time=None,
+        ticket=ticket,
+        user=user,
+    )
+    obj.stop(time(10, 45))
+    assert (45, 0) == _totals(user, ticket, d)
+
+
+@pytest.mark.django_db
+def test_totals_fixed_price_changed():
+    """The fixed price is read from the ticket (so it can be changed)."""
+    user = UserFactory(username='green')
+    ticket = TicketFactory(fixed_price=False)
+    d = date(2017, 3, 1)
+    TimeRecordFactory(
+        billable=True,
+        date_started=d,
+        start_time=time(10, 0),
+        end_time=time(10, 30),
+        ticket=ticket,
+        user=user,
+    )
+    row = TimeRecordDay.objects.totals(d, d).get()
+    assert (30, 0, 0) == (
+        row['charge_minutes'], row['fixed_minutes'], row['non_minutes']
+    )
+    ticket.fixed_price = True
+    ticket.save()
+    row = TimeRecordDay.objects.totals(d, d).get()
+    assert (0, 30, 0) == (
+        row['charge_minutes'], row['fixed_minutes'], row['non_minutes']
+    )
+
+
+@pytest.mark.django_db
+def test_verify():
+    ticket = TicketFactory()
+    TimeRecordFactory(ticket=ticket)
+    TimeRecordDay.objects.update(billable_minutes=1, non_billable_minutes=1)
+    assert 1 == len(TimeRecordDay.objects.verify())
+    TimeRecordDay.objects.rebuild()
+    assert [] == TimeRecordDay.objects.verify()
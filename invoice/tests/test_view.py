@@ -1,12 +1,21 @@
 # -*- encoding: utf-8 -*-
 import pytest
 
+from datetime import time, timedelta
 from decimal import Decimal
 from django.core.urlresolvers import reverse
+from django.utils import timezone
 
 from contact.tests.factories import ContactFactory
-from invoice.models import InvoiceContact, InvoiceUser
-from invoice.tests.factories import InvoiceContactFactory, TimeRecordFactory
+from crm.tests.factories import TicketFactory
+from invoice.models import InvoiceContact, InvoicePrintJob, InvoiceUser
+from invoice.tests.factories import (
+    InvoiceContactFactory,
+    InvoiceFactory,
+    InvoiceLineFactory,
+    TimeRecordFactory,
+)
+from invoice.views import DashMixin
 from login.tests.factories import TEST_PASSWORD, UserFactory
 
 
@@ -51,6 +60,69 @@ def test_invoice_contact_update(client):
     assert Decimal('12.34') == invoice_contact.hourly_rate
 
 
+@pytest.mark.django_db
+def test_invoice_create_pdf(client):
+    user = UserFactory(username='staff', is_staff=True)
+    assert client.login(username=user.username, password=TEST_PASSWORD) is True
+    invoice = InvoiceFactory()
+    InvoiceLineFactory(invoice=invoice)
+    url = reverse('invoice.create.pdf', kwargs={'pk': invoice.pk})
+    response = client.post(url)
+    assert 302 == response.status_code
+    job = InvoicePrintJob.objects.get(invoice=invoice)
+    expect = reverse('invoice.print.job', args=[job.pk])
+    assert expect == response['Location']
+    assert user == job.user
+
+
+@pytest.mark.django_db
+def test_invoice_print_job_stale(client):
+    """Stop checking a job which has been pending for too long."""
+    user = UserFactory(username='staff', is_staff=True)
+    assert client.login(username=user.username, password=TEST_PASSWORD) is True
+    job = InvoicePrintJob.objects.create_print_job(InvoiceFactory(), user)
+    url = reverse('invoice.print.job', args=[job.pk])
+    response = client.get(url)
+    assert 200 == response.status_code
+    assert 'window.location.reload' in response.content.decode()
+    InvoicePrintJob.objects.filter(pk=job.pk).update(
+        created=timezone.now() - timedelta(
+            minutes=InvoicePrintJob.STALE_MINUTES + 1
+        )
+    )
+    response = client.get(url)
+    assert 200 == response.status_code
+    content = response.content.decode()
+    assert 'has not been created yet' in content
+    assert 'window.location.reload' not in content
+
+
+@pytest.mark.django_db
+def test_dash_charts(rf):
+    """The charts only contain the time from this test.
+
+    The time for all users is cached (see ``time_summary_for_dash``), so the
+    cache must be cleared between tests (see ``conftest.py``).
+
+    """
+    user = UserFactory(username='green')
+    contact = ContactFactory(user=UserFactory(username='orange'))
+    TimeRecordFactory(
+        billable=True,
+        ticket=TicketFactory(contact=contact),
+        date_started=timezone.now().date(),
+        start_time=time(10, 0),
+        end_time=time(10, 30),
+        user=user,
+    )
+    view = DashMixin()
+    view.request = rf.get('/')
+    view.request.user = user
+    contact_chart, charge_chart, user_chart = view._charts()
+    assert {'x': ['orange'], 'y': [30]} == contact_chart['chartdata']
+    assert {'x': ['green'], 'y': [30]} == user_chart['chartdata']
+
+
 @pytest.mark.django_db
 def test_invoice_user_update(client):
     user = UserFactory(username='staff', is_staff=True)
@@ -9,6 +9,7 @@ from base.tests.test_utils import PermTestCase
 from contact.tests.factories import ContactFactory
 from crm.tests.factories import TicketFactory
 from finance.tests.factories import VatSettingsFactory
+from invoice.models import InvoicePrintJob
 from invoice.service import (
     InvoiceCreate,
     InvoicePrint,
@@ -130,6 +131,16 @@ def test_invoice_create_pdf(perm_check):
     perm_check.staff(url)
 
 
+@pytest.mark.django_db
+def test_invoice_print_job(perm_check):
+    job = InvoicePrintJob.objects.create_print_job(
+        InvoiceFactory(),
+        UserFactory(),
+    )
+    url = reverse('invoice.print.job', kwargs={'pk': job.pk})
+    perm_check.staff(url)
+
+
 @pytest.mark.django_db
 def test_invoice_update(perm_check):
     invoice = InvoiceFactory()
@@ -13,6 +13,7 @@ from .views import (
     InvoiceLineUpdateView,
     InvoiceListView,
     InvoicePdfUpdateView,
+    InvoicePrintJobDetailView,
     InvoiceRefreshTimeRecordsUpdateView,
     InvoiceRemoveTimeRecordsUpdateView,
     InvoiceSetToDraftUpdateView,
@@ -85,6 +86,10 @@ urlpatterns = [
         view=InvoicePdfUpdateView.as_view(),
         name='invoice.create.pdf'
         ),
+    url(regex=r'^invoice/print/job/(?P<pk>\d+)/$',
+        view=InvoicePrintJobDetailView.as_view(),
+        name='invoice.print.job'
+        ),
     url(regex=r'^invoice/(?P<pk>\d+)/refresh-time-records/$',
         view=InvoiceRefreshTimeRecordsUpdateView.as_view(),
         name='invoice.refresh.time.records'
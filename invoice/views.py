@@ -9,7 +9,13 @@ from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import get_user_model, REDIRECT_FIELD_NAME
 from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
-from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.db import transaction
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseRedirect,
+    StreamingHttpResponse,
+)
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from django.views.generic import (
@@ -43,6 +49,7 @@ from .models import (
     InvoiceContact,
     InvoiceError,
     InvoiceLine,
+    InvoicePrintJob,
     InvoiceUser,
     QuickTimeRecord,
     TimeRecord,
@@ -52,7 +59,9 @@ from .report import (
     ReportInvoiceTimeAnalysis,
     ReportInvoiceTimeAnalysisCSV,
     time_summary,
+    time_summary_for_dash,
 )
+from .tasks import invoice_print
 
 
 @staff_member_required
@@ -86,13 +95,15 @@ def report_invoice_time_analysis(request, pk):
 def report_invoice_time_analysis_csv(request, pk):
     invoice = get_object_or_404(Invoice, pk=pk)
     check_perm(request.user, invoice.contact)
-    response = HttpResponse(content_type='text/csv')
+    report = ReportInvoiceTimeAnalysisCSV()
+    response = StreamingHttpResponse(
+        report.stream(invoice),
+        content_type='text/csv',
+    )
     file_name = 'invoice_{}_time_analysis.csv'.format(invoice.pk)
     response['Content-Disposition'] = 'attachment; filename="{}"'.format(
         file_name
     )
-    report = ReportInvoiceTimeAnalysisCSV()
-    report.report(invoice, request.user, response)
     return response
 
 
@@ -117,7 +128,11 @@ class ContactInvoiceListView(
 
     def get_queryset(self):
         contact = self._contact()
-        return Invoice.objects.filter(contact=contact)
+        return Invoice.objects.filter(
+            contact=contact
+        ).select_related(
+            'contact',
+        )
 
 
 class InvoiceContactCreateView(
@@ -182,30 +197,24 @@ class DashMixin:
     NON_CHARGE = 'Non-Chargeable'
 
     def _charts(self):
-        from_date = timezone.now() + relativedelta(months=-1)
-        qs = TimeRecord.objects.filter(
-            date_started__gte=from_date,
-            date_started__lte=timezone.now(),
-        )
         charge = {self.CHARGE: 0, self.NON_CHARGE: 0}
         contact = {}
         user = {}
-        for row in qs:
-            if row.is_complete:
-                minutes = int(row.minutes)
-                user_name = row.user.username
-                if not user_name in user:
-                    user[user_name] = 0
-                user[user_name] = user[user_name] + minutes
-                if row.user == self.request.user:
-                    user_name = row.ticket.contact.user.username
-                    if not user_name in contact:
-                        contact[user_name] = 0
-                    contact[user_name] = contact[user_name] + minutes
-                    if row.billable:
-                        charge[self.CHARGE] = charge[self.CHARGE] + minutes
-                    else:
-                        charge[self.NON_CHARGE] = charge[self.NON_CHARGE] + minutes
+        for row in time_summary_for_dash():
+            minutes = row['minutes']
+            user_name = row['user__username']
+            if not user_name in user:
+                user[user_name] = 0
+            user[user_name] = user[user_name] + minutes
+            if row['user'] == self.request.user.pk:
+                user_name = row['ticket__contact__user__username']
+                if not user_name in contact:
+                    contact[user_name] = 0
+                contact[user_name] = contact[user_name] + minutes
+                if row['billable']:
+                    charge[self.CHARGE] = charge[self.CHARGE] + minutes
+                else:
+                    charge[self.NON_CHARGE] = charge[self.NON_CHARGE] + minutes
         contact_x = []
         contact_y = []
         for k in sorted(contact, key=contact.get, reverse=True):
@@ -296,9 +305,10 @@ class InvoiceDraftCreateView(
     def form_valid(self, form):
         self.object = form.save(commit=False)
         self.object.contact = self._contact()
-        self.object.number = Invoice.objects.next_number()
         self.object.user = self.request.user
-        return super().form_valid(form)
+        with transaction.atomic():
+            self.object.number = Invoice.objects.next_number()
+            return super().form_valid(form)
 
 
 class InvoiceLineCreateView(
@@ -323,9 +333,10 @@ class InvoiceLineCreateView(
     def form_valid(self, form):
         self.object = form.save(commit=False)
         self.object.invoice = self._get_invoice()
-        self.object.line_number = self.object.invoice.get_next_line_number()
         self.object.user = self.request.user
-        return super().form_valid(form)
+        with transaction.atomic():
+            self.object.line_number = self.object.invoice.get_next_line_number()
+            return super().form_valid(form)
 
 
 class InvoiceLineUpdateView(
@@ -360,16 +371,20 @@ class InvoicePdfUpdateView(
         return obj
 
     def form_valid(self, form):
-        InvoicePrint().create_pdf(self.object, header_image=None)
-        messages.info(
-            self.request,
-            "Created PDF for invoice {}, {} at {} today.".format(
-                self.object.invoice_number,
-                self.object.contact.get_full_name,
-                self.object.created.strftime("%H:%M"),
-            )
+        job = InvoicePrintJob.objects.create_print_job(
+            self.object, self.request.user
+        )
+        transaction.on_commit(lambda: invoice_print.delay(job.pk))
+        return HttpResponseRedirect(
+            reverse('invoice.print.job', args=[job.pk])
         )
-        return HttpResponseRedirect(reverse('invoice.list'))
+
+
+class InvoicePrintJobDetailView(
+        LoginRequiredMixin, StaffuserRequiredMixin, BaseMixin, DetailView):
+    """The status of a print job (the page refreshes until it finishes)."""
+
+    model = InvoicePrintJob
 
 
 class InvoiceRefreshTimeRecordsUpdateView(
@@ -504,7 +519,11 @@ class InvoiceListView(
     model = Invoice
 
     def get_queryset(self):
-        return Invoice.objects.all().order_by('-pk')
+        return Invoice.objects.all().select_related(
+            'contact',
+        ).order_by(
+            '-pk',
+        )
 
 
 class InvoiceUpdateView(